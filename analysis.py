@@ -0,0 +1,139 @@
+import argparse
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# the startup decryption loop; None marks the words that vary per binary:
+#   set r1 <start>
+#   rmem r0 r1; push r1; mult r1 r1 r1; call <xor>; set r1 <key>; call <xor>
+#   pop r1; wmem r1 r0; add r1 r1 1; eq r0 <end> r1
+DECRYPTOR = [
+    1, 32769, None,
+    15, 32768, 32769, 2, 32769, 10, 32769, 32769, 32769, 17, None, 1, 32769, None, 17, None,
+    3, 32769, 16, 32769, 32768, 9, 32769, 32769, 1, 4, 32768, None, 32769,
+]
+
+# a string printed through a callback that xors each character with r2:
+#   set r0 <table>; set r1 <callback>; add r2 <x> <y>; call <print>
+XOR_PRINT = [1, 32768, None, 1, 32769, None, 9, 32770, None, None, 17, None]
+# that callback: push r1; set r1 r2; call <xor>; out r0; pop r1; ret
+XOR_CALLBACK = [2, 32769, 1, 32769, 32770, 17, None, 19, 32768, 3, 32769, 18]
+
+
+def load(path: Path) -> np.ndarray:
+    return np.fromfile(path, dtype='<u2').astype(np.uint16)
+
+
+def find(words: np.ndarray, pattern: List[int]) -> np.ndarray:
+    # addresses where <pattern> matches, None matching anything
+    if len(words) < len(pattern):
+        return np.array([], dtype=int)
+    windows = sliding_window_view(words, len(pattern))
+    fixed = np.array([p is not None for p in pattern])
+    values = np.array([p or 0 for p in pattern], dtype=np.uint16)
+    return np.flatnonzero(((windows == values) | ~fixed).all(axis=1))
+
+
+def find_decryptor(words: np.ndarray) -> Tuple[int, int, int]:
+    # (first, end, key) of the range the startup code decrypts
+    found = find(words, DECRYPTOR)
+    if not len(found):
+        raise ValueError('no decryption loop found')
+    at = found[0]
+    return int(words[at + 2]), int(words[at + 30]), int(words[at + 16])
+
+
+def decrypt(words: np.ndarray) -> np.ndarray:
+    # what the startup loop does one word at a time:
+    #   memory[i] ^= (i * i % 32768) ^ key
+    first, end, key = find_decryptor(words)
+    address = np.arange(first, end, dtype=np.uint32)
+    out = words.copy()
+    out[first:end] ^= ((address * address % 32768) ^ key).astype(np.uint16)
+    return out
+
+
+def printable(words: np.ndarray) -> np.ndarray:
+    return ((words >= 32) & (words < 127)) | (words == 10)
+
+
+def out_runs(words: np.ndarray, min_length: int = 2) -> List[Tuple[int, str]]:
+    # consecutive "out <literal>" instructions, as in the self-test messages
+    is_out = np.zeros(len(words), dtype=bool)
+    is_out[:-1] = (words[:-1] == 19) & printable(words[1:])
+    runs = []
+    for parity in (0, 1):
+        lanes = is_out[parity::2].astype(np.int8)
+        edges = np.diff(np.concatenate(([0], lanes, [0])))
+        for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            if stop - start >= min_length:
+                first = parity + 2 * start
+                chars = words[first + 1:parity + 2 * stop:2]
+                runs.append((int(first), ''.join(map(chr, chars))))
+    return sorted(runs)
+
+
+def length_prefixed(words: np.ndarray, min_length: int = 3, max_length: int = 1024) -> List[Tuple[int, str]]:
+    # a length word followed by that many printable characters; candidates
+    # are tested all at once, then taken left to right without overlapping
+    size = len(words)
+    counts = np.concatenate(([0], np.cumsum(printable(words))))
+    address = np.arange(size)
+    length = words.astype(np.int64)
+    end = address + 1 + length
+    valid = (length >= min_length) & (length <= max_length) & (end <= size)
+    end = np.where(valid, end, size)
+    valid &= counts[end] - counts[np.minimum(address + 1, size)] == length
+    strings = []
+    taken = 0
+    for at in np.flatnonzero(valid):
+        if at < taken:
+            continue
+        stop = int(end[at])
+        strings.append((int(at), ''.join(map(chr, words[at + 1:stop]))))
+        taken = stop
+    return strings
+
+
+def xor_tables(words: np.ndarray) -> List[Tuple[int, int]]:
+    # (table address, key) of the length-prefixed strings the game prints
+    # through XOR_CALLBACK, whose key is the sum of two literals at the call
+    sites = find(words, XOR_PRINT)
+    callbacks = find(words, XOR_CALLBACK)
+    x, y = words[sites + 8], words[sites + 9]
+    sites = sites[np.isin(words[sites + 5], callbacks) & (x < 32768) & (y < 32768)]
+    keys = (words[sites + 8].astype(np.uint32) + words[sites + 9]) % 32768
+    return sorted(set(zip(words[sites + 2].tolist(), keys.tolist())))
+
+
+def xor_strings(words: np.ndarray) -> List[Tuple[int, str]]:
+    found = []
+    for table, key in xor_tables(words):
+        if table >= len(words):
+            continue
+        chars = words[table + 1:table + 1 + words[table]] ^ key
+        if len(chars) == words[table] and printable(chars).all():
+            found.append((table, ''.join(map(chr, chars))))
+    return found
+
+
+def strings(words: np.ndarray) -> List[Tuple[int, str, str]]:
+    # every printable string with its address and how it is stored
+    found = [(a, 'out', s) for a, s in out_runs(words)]
+    found += [(a, 'table', s) for a, s in length_prefixed(words)]
+    found += [(a, 'xor', s) for a, s in xor_strings(words)]
+    return sorted(found)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the strings of a Synacor binary offline')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--raw', action='store_true', help="don't decrypt first")
+    args = parser.parse_args()
+    image = load(Path(args.binary))
+    if not args.raw:
+        image = decrypt(image)
+    for a, kind, text in strings(image):
+        print(f'{a:5} {kind:5} {text!r}')
@@ -0,0 +1,254 @@
+import argparse
+import time
+from array import array
+from collections import Counter, deque
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+
+from loader import load_image
+from operations import ARITY, OPCODES, PURE
+from vm import VirtualMachine, image_digest
+
+# lane states
+RUNNING, HALTED, WAITING, FAULTED = range(4)
+
+
+class BatchMachine:
+    # <lanes> machines stepped in lockstep. Memory is lanes x 32776 words with
+    # the registers in the last eight columns, the same layout as
+    # VirtualMachine, so a raw operand indexes its register directly. Each
+    # step the running lanes are grouped by opcode; operands are gathered per
+    # lane, so lanes that diverged to different addresses still share a group
+    # as long as they run the same instruction.
+    def __init__(self, lanes: int, stack_size: int = 256, output_size: int = 1024):
+        self.lanes = lanes
+        self.memory = np.zeros((lanes, 32776), dtype=np.uint16)
+        self.registers = self.memory[:, 32768:]
+        self.image = np.zeros(32768, dtype=np.uint16)
+        self.size = 0
+        self.counter = np.zeros(lanes, dtype=np.int64)
+        self.stack = np.zeros((lanes, stack_size), dtype=np.uint16)
+        self.depth = np.zeros(lanes, dtype=np.int64)
+        self.status = np.full(lanes, RUNNING, dtype=np.uint8)
+        self.output = np.zeros((lanes, output_size), dtype=np.uint16)
+        self.written = np.zeros(lanes, dtype=np.int64)
+        self.input_buffers = [deque() for _ in range(lanes)]
+        self.steps = 0
+        # lane-level control, stack and I/O are written out below; the rest
+        # evaluate the opcode table's expressions over every lane at once
+        self.handlers = [getattr(self, f'op_{opcode.name}', None) or self.pure(op)
+                         for op, opcode in enumerate(OPCODES)]
+
+    @classmethod
+    def from_vm(cls, vm: VirtualMachine, lanes: int, **kwargs) -> 'BatchMachine':
+        # <lanes> copies of the state of a scalar machine
+        batch = cls(lanes, **kwargs)
+        batch.memory[:] = np.frombuffer(vm.memory, dtype=np.uint16)
+        batch.image[:] = np.frombuffer(vm.image, dtype=np.uint16)
+        batch.size = vm.size
+        batch.counter[:] = vm.counter
+        batch.push(np.arange(lanes), vm.stack)
+        for buffer in batch.input_buffers:
+            buffer.extend(vm.input_buffer)
+        return batch
+
+    def import_file(self, file: Path):
+        image = load_image(file)
+        self.size = len(image)
+        self.memory[:, :self.size] = image
+        self.image[:] = self.memory[0, :32768]
+
+    def add_commands(self, commands: List, lanes: Iterable[int] = None):
+        # queue input lines on <lanes>, all of them by default, and wake the
+        # ones waiting for input
+        for lane in range(self.lanes) if lanes is None else lanes:
+            for command in commands:
+                self.input_buffers[lane].extend(command)
+                self.input_buffers[lane].append('\n')
+            if self.status[lane] == WAITING:
+                self.status[lane] = RUNNING
+
+    def lane(self, i: int) -> VirtualMachine:
+        # the state of lane <i> as a scalar machine
+        vm = VirtualMachine()
+        vm.memory[:] = array('H', self.memory[i].tobytes())
+        vm.image = array('H', self.image.tobytes())
+        vm.image_digest = image_digest(vm.image)
+        vm.size = self.size
+        vm.counter = int(self.counter[i])
+        vm.memory_written()
+        vm.stack.reset(self.stack[i, :self.depth[i]].tobytes())
+        vm.input_buffer = deque(self.input_buffers[i])
+        vm.interactive = False
+        return vm
+
+    def text(self, i: int) -> str:
+        return ''.join(map(chr, self.output[i, :self.written[i]]))
+
+    def run(self, limit: int = None) -> int:
+        # step until no lane is running or <limit> steps; returns the steps taken
+        steps = 0
+        while limit is None or steps < limit:
+            lanes = np.flatnonzero(self.status == RUNNING)
+            if not len(lanes):
+                break
+            ops = self.memory[lanes, self.counter[lanes]]
+            first = ops[0]
+            if (ops == first).all():
+                self.execute(int(first), lanes)
+            else:
+                for op in np.unique(ops):
+                    self.execute(int(op), lanes[ops == op])
+            steps += 1
+        self.steps += steps
+        return steps
+
+    def execute(self, op: int, lanes: np.ndarray):
+        if op >= len(OPCODES):
+            self.status[lanes] = FAULTED
+            return
+        m = self.memory
+        pc = self.counter[lanes]
+        args = []
+        for i, role in enumerate(OPCODES[op].roles):
+            x = m[lanes, pc + i + 1]
+            if role != 'w':
+                x = np.where(x > 32767, m[lanes, x], x)
+            args.append(x)
+        self.counter[lanes] = self.handlers[op](lanes, pc, *args)
+
+    def pure(self, op: int):
+        # a handler storing PURE[op] of the operands, widened so sums and
+        # products don't wrap before their modulo
+        function = PURE[op]
+        size = 1 + ARITY[op]
+
+        def handler(lanes, pc, a, *args):
+            self.memory[lanes, a] = function(*(x.astype(np.int64) for x in args))
+            return pc + size
+        return handler
+
+    def push(self, lanes: np.ndarray, values):
+        depth = self.depth[lanes]
+        if len(values) and len(lanes) and depth.max() + len(values) > self.stack.shape[1]:
+            grown = np.zeros((self.lanes, 2 * (depth.max() + len(values))), dtype=np.uint16)
+            grown[:, :self.stack.shape[1]] = self.stack
+            self.stack = grown
+        for value in values:
+            self.stack[lanes, self.depth[lanes]] = value
+            self.depth[lanes] += 1
+
+    def pop(self, lanes: np.ndarray):
+        # (lanes that had a value, the values); an empty stack faults the
+        # lane, where the scalar machine raises StackUnderflow
+        empty = self.depth[lanes] == 0
+        self.status[lanes[empty]] = FAULTED
+        lanes = lanes[~empty]
+        self.depth[lanes] -= 1
+        return ~empty, self.stack[lanes, self.depth[lanes]]
+
+    def op_halt(self, lanes, pc):
+        self.status[lanes] = HALTED
+        return pc
+
+    def op_push(self, lanes, pc, a):
+        self.push(lanes, [a])
+        return pc + 2
+
+    def op_pop(self, lanes, pc, a):
+        ok, values = self.pop(lanes)
+        self.memory[lanes[ok], a[ok]] = values
+        return np.where(ok, pc + 2, pc)
+
+    def op_jmp(self, lanes, pc, a):
+        return a
+
+    def op_jt(self, lanes, pc, a, b):
+        return np.where(a != 0, b, pc + 3)
+
+    def op_jf(self, lanes, pc, a, b):
+        return np.where(a == 0, b, pc + 3)
+
+    def op_mod(self, lanes, pc, a, b, c):
+        # modulo zero faults the lane, where the scalar machine raises
+        zero = c == 0
+        self.status[lanes[zero]] = FAULTED
+        ok = ~zero
+        self.memory[lanes[ok], a[ok]] = b[ok] % c[ok]
+        return np.where(ok, pc + 4, pc)
+
+    def op_rmem(self, lanes, pc, a, b):
+        self.memory[lanes, a] = self.memory[lanes, b]
+        return pc + 3
+
+    def op_wmem(self, lanes, pc, a, b):
+        self.memory[lanes, a] = b
+        return pc + 3
+
+    def op_call(self, lanes, pc, a):
+        self.push(lanes, [pc + 2])
+        return a
+
+    def op_ret(self, lanes, pc):
+        # an empty stack halts the lane, as the spec says
+        empty = self.depth[lanes] == 0
+        self.status[lanes[empty]] = HALTED
+        live = lanes[~empty]
+        self.depth[live] -= 1
+        nxt = pc.copy()
+        nxt[~empty] = self.stack[live, self.depth[live]]
+        return nxt
+
+    def op_out(self, lanes, pc, a):
+        written = self.written[lanes]
+        if written.max() >= self.output.shape[1]:
+            grown = np.zeros((self.lanes, 2 * self.output.shape[1]), dtype=np.uint16)
+            grown[:, :self.output.shape[1]] = self.output
+            self.output = grown
+        self.output[lanes, written] = a
+        self.written[lanes] += 1
+        return pc + 2
+
+    def op_in(self, lanes, pc, a):
+        # input is per lane; a lane with none left waits at the instruction
+        # until add_commands() gives it more
+        nxt = pc + 2
+        for i, lane in enumerate(lanes):
+            buffer = self.input_buffers[lane]
+            if buffer:
+                self.memory[lane, a[i]] = ord(buffer.popleft())
+            else:
+                self.status[lane] = WAITING
+                nxt[i] = pc[i]
+        return nxt
+
+    def op_noop(self, lanes, pc):
+        return pc + 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many copies of a Synacor binary in lockstep')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--lanes', type=int, default=256)
+    parser.add_argument('--commands', help='input lines given to every lane')
+    parser.add_argument('--r7', action='store_true', help='set r7 to the lane number before starting')
+    parser.add_argument('--steps', type=int, help='stop after this many lockstep steps')
+    args = parser.parse_args()
+    batch = BatchMachine(args.lanes)
+    batch.import_file(Path(args.binary))
+    if args.r7:
+        batch.registers[:, 7] = np.arange(args.lanes) % 32768
+    if args.commands:
+        batch.add_commands(Path(args.commands).read_text().splitlines())
+    start = time.perf_counter()
+    steps = batch.run(args.steps)
+    elapsed = time.perf_counter() - start
+    print(f'{args.lanes} lanes, {steps} steps in {elapsed:.2f}s, '
+          f'{args.lanes * steps / elapsed:,.0f} lane instructions/s')
+    print('states', dict(Counter(['running', 'halted', 'waiting', 'faulted'][s] for s in batch.status)))
+    outputs = Counter(batch.text(i) for i in range(args.lanes))
+    for text, count in outputs.most_common():
+        print(f'--- {count} lanes ---')
+        print(text[-400:])
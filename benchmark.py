@@ -0,0 +1,227 @@
+import argparse
+import contextlib
+import copy
+import fnmatch
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import struct
+import sys
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import List, Tuple
+
+from engine import ENGINES, Machine
+from vm import VirtualMachine
+
+# register operands for the synthetic programs
+R0, R1, R2, R3, R4 = range(32768, 32773)
+# where the synthetic programs keep a subroutine and a data word
+SUBROUTINE = 1000
+DATA = 2000
+# loop iterations of the opcode micro-benchmarks and of the tight loop
+ITERATIONS = 20000
+LOOP_ITERATIONS = 30000
+
+
+def startup(engine):
+    # self-test and string decryption, up to the first input prompt
+    vm = engine()
+    vm.import_file(Path('challenge.bin'))
+    vm.interactive = False
+    return vm
+
+
+def walkthrough(engine):
+    vm = startup(engine)
+    vm.add_commands(Path('bot_commands.txt').read_text().splitlines())
+    return vm
+
+
+def program(body, iterations: int) -> List[int]:
+    # set r2 = 12345, r3 = 7, r4 = 0, then run <body> <iterations> times
+    # counting r0 down; body(address) gives the words of a body placed at
+    # <address>. A ret sits at SUBROUTINE for call to use
+    words = [0] * (DATA + 1)
+    code = [1, R0, iterations, 1, R2, 12345, 1, R3, 7, 1, R4, 0]
+    loop = len(code)
+    code += body(loop)
+    code += [9, R0, R0, 32767, 7, R0, loop, 0]
+    words[:len(code)] = code
+    words[SUBROUTINE] = 18
+    return words
+
+
+def synthetic(words: List[int], commands: List[str], engine):
+    vm = engine()
+    vm.memory[:len(words)] = array('H', words)
+    vm.size = len(words)
+    vm.rebase()
+    vm.interactive = False
+    vm.add_commands(commands)
+    return vm
+
+
+# the instructions each micro-benchmark repeats; push and call need their
+# pop and ret to keep the stack flat
+MICRO = {
+    'set': lambda at: [1, R1, R2],
+    'push+pop': lambda at: [2, R2, 3, R1],
+    'eq': lambda at: [4, R1, R2, R3],
+    'gt': lambda at: [5, R1, R2, R3],
+    'jmp': lambda at: [6, at + 2],
+    'jt': lambda at: [7, R3, at + 3],
+    'jf': lambda at: [8, R4, at + 3],
+    'add': lambda at: [9, R1, R2, R3],
+    'mult': lambda at: [10, R1, R2, R3],
+    'mod': lambda at: [11, R1, R2, R3],
+    'and': lambda at: [12, R1, R2, R3],
+    'or': lambda at: [13, R1, R2, R3],
+    'not': lambda at: [14, R1, R2],
+    'rmem': lambda at: [15, R1, DATA],
+    'wmem': lambda at: [16, DATA, R2],
+    'call+ret': lambda at: [17, SUBROUTINE],
+    'out': lambda at: [19, R3],
+    'in': lambda at: [20, R1],
+    'noop': lambda at: [21],
+}
+
+workloads = {
+    'startup': startup,
+    'walkthrough': walkthrough,
+    # a sum in a counted loop, unrolled to ten instructions per iteration
+    'loop': partial(synthetic, program(lambda at: [9, R1, R1, R0] * 8, LOOP_ITERATIONS), []),
+}
+for micro_name, micro_body in MICRO.items():
+    workloads[f'op-{micro_name}'] = partial(
+        synthetic, program(micro_body, ITERATIONS), ['a' * ITERATIONS] if micro_name == 'in' else [])
+
+
+def measure(workload, engine, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        vm = workload(engine)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            vm.run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def instructions(workload) -> int:
+    # guest instructions the workload executes, the same for every engine
+    vm = workload(Machine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return vm.step(sys.maxsize)
+
+
+def bench(engine_name: str, workload_name: str, repeat: int) -> Tuple[float, int, int]:
+    # (best wall time, peak traced allocation in bytes, peak RSS in KiB),
+    # run in a fresh process so the RSS belongs to this workload alone
+    engine = ENGINES[engine_name]
+    workload = workloads[workload_name]
+    wall = measure(workload, engine, repeat)
+    vm = workload(engine)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.run()
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return wall, allocated, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def suite(engine_names: List[str], workload_names: List[str], repeat: int = 3) -> List[dict]:
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for workload_name in workload_names:
+        count = instructions(workloads[workload_name])
+        for engine_name in engine_names:
+            # one benchmark at a time, each in a freshly spawned process
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                wall, allocated, rss = pool.submit(bench, engine_name, workload_name, repeat).result()
+            results.append({
+                'workload': workload_name,
+                'engine': engine_name,
+                'instructions': count,
+                'wall': wall,
+                'ips': count / wall,
+                'rss_kib': rss,
+                'allocated_kib': allocated / 1024,
+            })
+    return results
+
+
+def list_state():
+    # the list-based memory, registers and stack VirtualMachine used to keep
+    memory = [i[0] for i in struct.iter_unpack('<H', Path('challenge.bin').read_bytes())]
+    return memory, [0, 0, 0, 0, 0, 0, 0, 0], []
+
+
+def array_state():
+    vm = VirtualMachine()
+    vm.import_file(Path('challenge.bin'))
+    return vm.memory, vm.registers, vm.stack
+
+
+def footprint(factory, copies: int = 100):
+    # built once untraced first, so imports done on first use are not counted
+    factory()
+    tracemalloc.start()
+    state = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    memory = state[0]
+    start = time.perf_counter()
+    for _ in range(copies):
+        copy.copy(memory)
+    return size, (time.perf_counter() - start) / copies
+
+
+def matches(name: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatch(name, p) for p in patterns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the VM engines on fixed workloads')
+    parser.add_argument('--engines', nargs='+', default=['*'], help='engine name patterns')
+    parser.add_argument('--workloads', nargs='+', default=['*'], help='workload name patterns')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('--baseline', help='results of an earlier --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown flagged as a regression')
+    args = parser.parse_args()
+    chosen_engines = [e for e in ENGINES if matches(e, args.engines)]
+    chosen_workloads = [w for w in workloads if matches(w, args.workloads)]
+    records = suite(chosen_engines, chosen_workloads, args.repeat)
+    previous = {}
+    if args.baseline:
+        previous = {(r['workload'], r['engine']): r for r in json.loads(Path(args.baseline).read_text())['results']}
+    regressions = 0
+    # name columns as wide as the longest name
+    wide = max(map(len, workloads))
+    engine_wide = max(map(len, ENGINES))
+    print(f'{"workload":{wide}} {"engine":{engine_wide}} {"instructions":>12} {"wall":>9} {"ips":>12} {"rss":>9} {"allocated":>10}')
+    for r in records:
+        line = (f'{r["workload"]:{wide}} {r["engine"]:{engine_wide}} {r["instructions"]:12} {r["wall"]:8.4f}s '
+                f'{r["ips"]:12,.0f} {r["rss_kib"] / 1024:7.1f}MB {r["allocated_kib"]:8.1f}KB')
+        before = previous.get((r['workload'], r['engine']))
+        if before:
+            ratio = r['ips'] / before['ips']
+            line += f' {ratio:5.2f}x'
+            if ratio < 1 - args.tolerance:
+                line += ' REGRESSION'
+                regressions += 1
+        print(line)
+    if args.json:
+        Path(args.json).write_text(json.dumps({'python': platform.python_version(), 'results': records}, indent=1))
+    for name, factory in (('list', list_state), ('array', array_state)):
+        size, copy_time = footprint(factory)
+        print(f'{"memory":{wide}} {name:{engine_wide}} {size / 1024:8.1f}KiB {copy_time * 1e6:8.1f}us per copy')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,287 @@
+from array import array
+from functools import lru_cache
+
+from operations import ARITY, CHECKED_STEPS, OPCODES, PAGE_BITS, substitute
+from stack import StackUnderflow
+from vm import VirtualMachine
+
+# opcodes that end a basic block
+TERMINATORS = {0, 6, 7, 8, 17, 18}
+# jmp and call, whose literal targets are compiled into the same block
+FOLLOWED = {6, 17}
+# instructions a block may take in by following jumps and calls
+MAX_BLOCK = 64
+# times the run loop reaches an address before compiling a block there;
+# most blocks on the way to the first prompt only ever run once, and
+# interpreting those is far cheaper than compiling them
+HOT = 2
+# compiled block sources kept for reuse by other machines in the process
+CACHED_BLOCKS = 4096
+
+
+@lru_cache(maxsize=CACHED_BLOCKS)
+def block_code(source: str, start: int):
+    # compiling the source is most of what a new block costs; machines
+    # running the same binary generate the same sources, so they share it
+    return compile(source, f'<block {start}>', 'exec')
+
+
+class VirtualMachineCompiled(VirtualMachine):
+    # blocks are compiled where the run loop has arrived <hot> times
+    def __init__(self, hot: int = HOT):
+        super().__init__()
+        self.hot = hot
+        # the registers while run() is in compiled code; list items are
+        # cheaper to load and store than array words, so blocks keep them
+        # here and memory only gets them back around everything else
+        self.regs = [0] * 8
+        # block start -> compiled function returning the next counter, and
+        # the instructions it runs when it runs to its end
+        self.blocks = {}
+        self.lengths = {}
+        # times the run loop reached each address with no block there
+        self.heat = bytearray(len(self.memory))
+        # memory address -> start addresses of compiled blocks covering it
+        self.covers = {}
+        # code addresses that were written to after being compiled; these are
+        # always run through the interpreter from then on
+        self.tainted = set()
+        # instructions of a block step() stopped inside that are still to be
+        # stepped singly, and those a block that left early did not run
+        self.tail = 0
+        self.skipped = 0
+
+    def run(self):
+        self.running = True
+        blocks = self.blocks
+        heat = self.heat
+        hot = self.hot
+        memory = self.memory
+        regs = self.regs
+        stack = self.stack
+        regs[:] = self.registers
+        pc = self.counter
+        try:
+            while self.running:
+                block = blocks.get(pc)
+                if block is None:
+                    if heat[pc] < hot:
+                        heat[pc] += 1
+                    if heat[pc] >= hot:
+                        block = self.compile_block(pc)
+                    if block is None:
+                        self.store_registers()
+                        pc = CHECKED_STEPS[memory[pc]](self, memory, pc, stack)
+                        regs[:] = self.registers
+                        continue
+                pc = block(memory, regs, stack)
+        finally:
+            self.counter = pc
+            self.store_registers()
+        self.output.flush()
+
+    def step(self, limit: int = 1) -> int:
+        # as VirtualMachine.step; a block counts as its instructions, less the
+        # ones it skipped when a write into compiled code or an accelerated
+        # call left it early
+        self.running = True
+        blocks = self.blocks
+        lengths = self.lengths
+        heat = self.heat
+        hot = self.hot
+        memory = self.memory
+        regs = self.regs
+        stack = self.stack
+        regs[:] = self.registers
+        pc = self.counter
+        tail = self.tail
+        done = 0
+        try:
+            while self.running and done < limit:
+                if tail:
+                    # the rest of a block the limit fell inside, stepped
+                    # without heating the addresses inside it
+                    self.store_registers()
+                    while tail and self.running and done < limit:
+                        pc = CHECKED_STEPS[memory[pc]](self, memory, pc, stack)
+                        done += 1
+                        tail -= 1
+                    regs[:] = self.registers
+                    continue
+                left = limit - done
+                while left and self.running:
+                    block = blocks.get(pc)
+                    if block is None:
+                        if heat[pc] < hot:
+                            heat[pc] += 1
+                        if heat[pc] >= hot:
+                            block = self.compile_block(pc)
+                        if block is None:
+                            self.store_registers()
+                            pc = CHECKED_STEPS[memory[pc]](self, memory, pc, stack)
+                            regs[:] = self.registers
+                            left -= 1
+                            continue
+                    n = lengths[pc]
+                    if n > left:
+                        # the limit falls inside the block, so it is stepped
+                        # through instead
+                        tail = n
+                        break
+                    left -= n
+                    pc = block(memory, regs, stack)
+                # blocks that left early were counted whole
+                done = limit - left - self.skipped
+                self.skipped = 0
+        finally:
+            self.counter = pc
+            self.tail = tail
+            self.store_registers()
+        return done - 1 if self.waiting() else done
+
+    def store_registers(self):
+        self.registers[:] = array('H', self.regs)
+
+    def invalidate(self, address: int):
+        if address in self.covers:
+            self.tainted.add(address)
+            for start in self.covers.pop(address):
+                if start not in self.accelerated:
+                    self.blocks.pop(start, None)
+
+    def accelerate(self, address: int, routine):
+        # the routine sees memory's registers, so the block register file is
+        # stored before it and reloaded after. Calls land on the target
+        # address, so it is also installed as the block there; it returns
+        # straight to the caller
+        def synced(vm):
+            self.store_registers()
+            routine(vm)
+            self.regs[:] = self.registers
+        super().accelerate(address, synced)
+
+        def block(m, regs, st):
+            synced(self)
+            return st.ret()
+        self.blocks[address] = block
+        self.lengths[address] = 1
+
+    def memory_reloaded(self, start: int, end: int):
+        # restored memory is not self-modification, so blocks are recompiled
+        # rather than tainted
+        for address in range(start, end):
+            self.tainted.discard(address)
+            for block in self.covers.pop(address, ()):
+                if block not in self.accelerated:
+                    self.blocks.pop(block, None)
+
+    def set_value(self, n, v):
+        self.memory[n] = v
+        self.dirty[n >> PAGE_BITS] = 1
+        if n in self.covers:
+            self.invalidate(n)
+
+    def compile_block(self, start: int):
+        memory = self.memory
+        lines = []
+        reads = set()
+        writes = set()
+
+        def value(x):
+            if x > 32767:
+                reads.add(x - 32768)
+                return f'r{x - 32768}'
+            return str(x)
+
+        def write_memory(address, expr, nxt):
+            lines.append(f'a = {address}')
+            lines.append(f'm[a] = {expr}')
+            lines.append(f'dirty[a >> {PAGE_BITS}] = 1')
+            lines.append('if a in covers:')
+            lines.append('    vm.invalidate(a)')
+            lines.append(f'    @SKIP{len(seen)}@')
+            lines.append('    @WB@')
+            lines.append(f'    return {nxt}')
+
+        pc = start
+        # instruction addresses in the block, so a jump back into it ends it
+        seen = set()
+        while True:
+            if pc in self.tainted or pc > 32767 or pc in seen:
+                break
+            op = memory[pc]
+            if op >= len(ARITY) or op == 20:
+                break
+            nxt = pc + 1 + ARITY[op]
+            args = memory[pc + 1:nxt]
+            if len(args) < ARITY[op] or any(x > 32775 for x in args):
+                break
+            if any(x in self.tainted for x in range(pc + 1, nxt)):
+                break
+            seen.add(pc)
+            for x in range(pc, nxt):
+                self.covers.setdefault(x, set()).add(start)
+            # the opcode's python from the table, with operands, nxt and pc
+            # as literals or register locals
+            opcode = OPCODES[op]
+            names = {'nxt': str(nxt), 'pc': str(pc)}
+            for role, x, name in zip(opcode.roles, args, 'abc'):
+                if role != 'w':
+                    names[name] = value(x)
+            if opcode.jump is not None:
+                # the effect may leave the block, so registers are written back first
+                lines.append('@WB@')
+            for line in opcode.effect:
+                stripped = line.lstrip()
+                indent = line[:len(line) - len(stripped)]
+                if stripped.startswith('return'):
+                    lines.append(f'{indent}@SKIP{len(seen)}@')
+                if stripped.startswith(('return', 'raise')) and opcode.jump is None:
+                    lines.append(indent + '@WB@')
+                lines.append(substitute(line, names))
+            if opcode.value is None:
+                pass
+            elif opcode.roles[0] == 's':
+                write_memory(names['a'], substitute(opcode.value, names), nxt)
+            elif args[0] > 32767:
+                writes.add(args[0] - 32768)
+                reads.add(args[0] - 32768)
+                lines.append(f'r{args[0] - 32768} = {substitute(opcode.value, names)}')
+            else:
+                write_memory(str(args[0]), substitute(opcode.value, names), nxt)
+            if opcode.jump is not None:
+                jump = substitute(opcode.jump, names)
+                if op in FOLLOWED and jump.isdigit() and len(seen) < MAX_BLOCK:
+                    # the block goes on at a literal target, so a call
+                    # site and the routine it calls run as one function
+                    pc = int(jump)
+                    continue
+                lines.append(f'return {jump}')
+            pc = nxt
+            if op in TERMINATORS:
+                break
+        if not seen:
+            return None
+        last = lines[-1] if lines else ''
+        if not last.startswith('return'):
+            lines.append('@WB@')
+            lines.append(f'return {pc}')
+
+        write_back = '; '.join(f'regs[{r}] = r{r}' for r in sorted(writes)) or 'pass'
+        body = [f'r{r} = regs[{r}]' for r in sorted(reads)]
+        for line in lines:
+            if '@SKIP' in line:
+                # a return after instruction <n> of the block adds the ones it
+                # left unrun for step()
+                n = int(line.strip()[5:-1])
+                if n == len(seen):
+                    continue
+                line = line.replace(f'@SKIP{n}@', f'vm.skipped += {len(seen) - n}')
+            body.append(line.replace('@WB@', write_back))
+        source = f'def block_{start}(m, regs, st):\n' + ''.join(f'    {line}\n' for line in body)
+        namespace = {'vm': self, 'covers': self.covers, 'dirty': self.dirty, 'StackUnderflow': StackUnderflow}
+        exec(block_code(source, start), namespace)
+        block = namespace[f'block_{start}']
+        self.blocks[start] = block
+        self.lengths[start] = len(seen)
+        return block
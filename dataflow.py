@@ -0,0 +1,311 @@
+import argparse
+from bisect import bisect_right
+from collections import deque
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from disassembler import trace_code
+from operations import ARITY, NAMES
+
+# an abstract value is the interval (lo, hi) of values a word may hold
+Interval = Tuple[int, int]
+TOP = (0, 65535)
+WORD = (0, 32767)
+# joins at one address before changing registers are widened to TOP
+WIDEN = 4
+# rmem over at most this many words is read as the range of their values
+TABLE = 64
+# analysis passes before giving up on the set of written words settling
+PASSES = 12
+
+
+def interval_add(a: Interval, b: Interval) -> Interval:
+    hi = a[1] + b[1]
+    return (a[0] + b[0], hi) if hi < 32768 else WORD
+
+
+def interval_mult(a: Interval, b: Interval) -> Interval:
+    hi = a[1] * b[1]
+    return (a[0] * b[0], hi) if hi < 32768 else WORD
+
+
+def interval_mod(a: Interval, b: Interval) -> Interval:
+    if a[0] == a[1] and b[0] == b[1] and b[0]:
+        return a[0] % b[0], a[0] % b[0]
+    if b[0] and a[1] < b[0]:
+        return a
+    return 0, max(0, min(a[1], b[1] - 1))
+
+
+def interval_and(a: Interval, b: Interval) -> Interval:
+    if a[0] == a[1] and b[0] == b[1]:
+        return a[0] & b[0], a[0] & b[0]
+    return 0, min(a[1], b[1])
+
+
+def interval_or(a: Interval, b: Interval) -> Interval:
+    if a[0] == a[1] and b[0] == b[1]:
+        return a[0] | b[0], a[0] | b[0]
+    return max(a[0], b[0]), (1 << max(a[1], b[1]).bit_length()) - 1
+
+
+def interval_not(a: Interval) -> Interval:
+    if a[1] > 32767:
+        return WORD
+    return 32767 - a[1], 32767 - a[0]
+
+
+def interval_eq(a: Interval, b: Interval) -> Interval:
+    if a[0] == a[1] == b[0] == b[1]:
+        return 1, 1
+    if a[1] < b[0] or b[1] < a[0]:
+        return 0, 0
+    return 0, 1
+
+
+def interval_gt(a: Interval, b: Interval) -> Interval:
+    if a[0] > b[1]:
+        return 1, 1
+    if a[1] <= b[0]:
+        return 0, 0
+    return 0, 1
+
+
+ARITHMETIC = {
+    4: interval_eq,
+    5: interval_gt,
+    9: interval_add,
+    10: interval_mult,
+    11: interval_mod,
+    12: interval_and,
+    13: interval_or,
+}
+
+
+def join(a: Tuple[Interval, ...], b: Tuple[Interval, ...]) -> Tuple[Interval, ...]:
+    return tuple((min(x[0], y[0]), max(x[1], y[1])) for x, y in zip(a, b))
+
+
+class Writes:
+    # merged, sorted address intervals that some instruction may write
+    def __init__(self, intervals: Iterable[Interval] = ()):
+        merged = []
+        for lo, hi in sorted(intervals):
+            if merged and lo <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+            else:
+                merged.append((lo, hi))
+        self.intervals = merged
+        self.starts = [lo for lo, _ in merged]
+
+    def hits(self, lo: int, hi: int) -> bool:
+        i = bisect_right(self.starts, hi) - 1
+        return i >= 0 and self.intervals[i][1] >= lo
+
+    def __eq__(self, other) -> bool:
+        return self.intervals == other.intervals
+
+
+def return_addresses(memory, stack) -> List[int]:
+    # the stack words that follow a call instruction, which is where every
+    # return address points
+    return [w for w in stack if 2 <= w < 32768 and memory[w - 2] == 17]
+
+
+class Analysis:
+    # abstract interpretation of the code reachable from <entries> over
+    # intervals per register. Calls are assumed to return to the word after
+    # them with every register unknown; jumps and calls through unknown
+    # registers go to every routine the disassembler found. Memory reads
+    # are constant only for words no reachable instruction may write, which
+    # is settled by rerunning until the set of writes stops growing
+    def __init__(self, memory, size: int, entries: Iterable[int] = (0,), registers: Tuple[Interval, ...] = None):
+        self.memory = memory
+        self.size = size
+        self.entries = list(entries)
+        self.start = registers or (TOP,) * 8
+        self.code, functions, targets, subroutines = trace_code(memory, size, self.entries)
+        self.routines = sorted(functions | subroutines)
+        self.written = Writes()
+        for _ in range(PASSES):
+            self.interpret()
+            written = Writes(self.targets.values())
+            if written == self.written:
+                break
+            self.written = written
+        self.code_words = Writes((a, a + ARITY[memory[a]]) for a in self.states if memory[a] < len(ARITY))
+
+    def value(self, state: Tuple[Interval, ...], x: int) -> Interval:
+        if x > 32767:
+            return state[x - 32768] if x < 32776 else TOP
+        return x, x
+
+    def read(self, address: Interval) -> Interval:
+        lo, hi = address
+        if hi > 32767 or hi - lo >= TABLE or self.written.hits(lo, hi):
+            return TOP
+        words = self.memory[lo:hi + 1]
+        return min(words), max(words)
+
+    def interpret(self):
+        memory = self.memory
+        self.states = {}
+        self.visits = {}
+        # pc -> interval of the address an instruction writes to memory
+        self.targets = {}
+        # pc -> True/False for a jt/jf whose condition never varies
+        self.decided = {}
+        self.indirect = set()
+        todo = deque()
+        for entry in self.entries:
+            self.merge(todo, entry, self.start)
+        while todo:
+            pc = todo.popleft()
+            state = self.states[pc]
+            op = memory[pc]
+            if op >= len(ARITY) or pc + ARITY[op] >= self.size:
+                continue
+            args = memory[pc + 1:pc + 1 + ARITY[op]]
+            nxt = pc + 1 + ARITY[op]
+            out = list(state)
+            written = None
+            result = None
+            if op == 1:
+                result = self.value(state, args[1])
+            elif op in ARITHMETIC:
+                result = ARITHMETIC[op](self.value(state, args[1]), self.value(state, args[2]))
+            elif op == 14:
+                result = interval_not(self.value(state, args[1]))
+            elif op == 15:
+                result = self.read(self.value(state, args[1]))
+            elif op in (3, 20):
+                result = TOP
+            elif op == 16:
+                written = self.value(state, args[0])
+            if result is not None:
+                if args[0] > 32767:
+                    out[args[0] - 32768] = result
+                else:
+                    written = (args[0], args[0])
+            if written is not None:
+                self.targets[pc] = (written[0], min(written[1], 32767))
+            out = tuple(out)
+            if op in (0, 18):
+                continue
+            if op in (6, 7, 8):
+                target = self.value(state, args[-1])
+                taken = True
+                if op != 6:
+                    condition = self.value(state, args[0])
+                    if condition[0] > 0 or condition == (0, 0):
+                        self.decided[pc] = (condition[0] > 0) == (op == 7)
+                        taken = self.decided[pc]
+                    else:
+                        self.decided.pop(pc, None)
+                    if not taken or pc not in self.decided:
+                        self.merge(todo, nxt, out)
+                if taken:
+                    self.branch(todo, pc, target, out)
+                continue
+            if op == 17:
+                self.branch(todo, pc, self.value(state, args[0]), out)
+                out = (TOP,) * 8
+            self.merge(todo, nxt, out)
+
+    def branch(self, todo: deque, pc: int, target: Interval, state: Tuple[Interval, ...]):
+        if target[0] == target[1]:
+            self.merge(todo, target[0], state)
+            return
+        self.indirect.add(pc)
+        for routine in self.routines:
+            self.merge(todo, routine, (TOP,) * 8)
+
+    def merge(self, todo: deque, pc: int, state: Tuple[Interval, ...]):
+        if pc >= self.size:
+            return
+        old = self.states.get(pc)
+        if old is None:
+            self.states[pc] = state
+            todo.append(pc)
+            return
+        new = join(old, state)
+        if new == old:
+            return
+        self.visits[pc] = self.visits.get(pc, 0) + 1
+        if self.visits[pc] > WIDEN:
+            new = tuple(TOP if n != o else n for n, o in zip(new, old))
+        self.states[pc] = new
+        todo.append(pc)
+
+    def constant(self, pc: int, register: int) -> Optional[int]:
+        # the value register <register> always holds when <pc> runs, if one
+        state = self.states.get(pc)
+        if state is None:
+            return None
+        lo, hi = state[register]
+        return lo if lo == hi else None
+
+    def writes_code(self, pc: int) -> bool:
+        # whether the memory write at <pc> may land on reachable code; always
+        # True for an instruction the analysis never reached, since nothing
+        # is known about where it writes
+        if pc not in self.states:
+            return True
+        target = self.targets.get(pc)
+        return target is None or self.code_words.hits(*target)
+
+    def unreachable(self) -> List[Interval]:
+        # runs of disassembled instructions the analysis never reaches
+        runs = []
+        for address in range(self.size):
+            if self.code[address] == 1 and address not in self.states:
+                end = address + ARITY[self.memory[address]]
+                if runs and runs[-1][1] + 1 >= address:
+                    runs[-1] = (runs[-1][0], end)
+                else:
+                    runs.append((address, end))
+        return runs
+
+    def report(self) -> str:
+        memory = self.memory
+        lines = [f'{len(self.states)} reachable instructions from {self.entries}']
+        folded = [(pc, r, self.constant(pc, r - 32768))
+                  for pc in sorted(self.states) if memory[pc] < len(ARITY)
+                  for r in memory[pc + 1:pc + 1 + ARITY[memory[pc]]]
+                  if 32767 < r < 32776 and self.constant(pc, r - 32768) is not None]
+        lines.append(f'{len(folded)} register operands are constant')
+        for pc, r, value in folded[:20]:
+            lines.append(f'  {pc:5} {NAMES[memory[pc]]:5} r{r - 32768} = {value}')
+        lines.append(f'{len(self.decided)} branches always go one way')
+        for pc, taken in sorted(self.decided.items())[:20]:
+            lines.append(f'  {pc:5} {NAMES[memory[pc]]:5} {"always" if taken else "never"} jumps')
+        lines.append(f'{len(self.indirect)} jumps and calls through registers, sent to {len(self.routines)} routines')
+        unknown = sorted(pc for pc, (lo, hi) in self.targets.items() if hi - lo > TABLE)
+        code = sorted(pc for pc in self.targets if self.writes_code(pc))
+        lines.append(f'{len(self.targets)} memory writes, {len(unknown)} to addresses not narrowed to a table')
+        lines.append(f'{len(code)} may write reachable code: {code[:40]}')
+        never = sum(1 for pc in self.targets if not self.writes_code(pc))
+        lines.append(f'{never} writes proven never to hit reachable code')
+        runs = self.unreachable()
+        lines.append(f'{len(runs)} unreachable runs of disassembled code')
+        for lo, hi in runs[:20]:
+            lines.append(f'  {lo:5}..{hi}')
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Constant propagation and reachability for a Synacor binary')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--decrypted', action='store_true', help='analyse the state at the first prompt instead')
+    args = parser.parse_args()
+    if args.decrypted:
+        from explorer import boot
+        vm = boot(args.binary)
+        # the prompt loop and every return address still on the stack
+        analysis = Analysis(vm.memory, vm.size, [vm.counter] + return_addresses(vm.memory, vm.stack))
+    else:
+        from vm import VirtualMachine
+        vm = VirtualMachine()
+        vm.import_file(Path(args.binary))
+        analysis = Analysis(vm.memory, vm.size, [0], ((0, 0),) * 8)
+    print(analysis.report(), end='')
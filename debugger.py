@@ -0,0 +1,191 @@
+import argparse
+import shlex
+from array import array
+from pathlib import Path
+from typing import List, Optional
+
+from engine import Machine, destination
+from operations import ARITY, STEPS, format_instruction
+from tracer import NO_WRITE
+
+
+class Debugger:
+    # breakpoints and watchpoints over a Machine. With nothing set, run() is
+    # the machine's own run loop, untouched. Otherwise it swaps in an
+    # instrumented loop through the step functions, which looks up where
+    # each instruction writes and checks the watches against that
+    def __init__(self, vm: Machine):
+        self.vm = vm
+        self.breakpoints = set()
+        # (start, end) address ranges; any write inside one stops the run
+        self.memory_watches = []
+        # register numbers; a write that changes one stops the run
+        self.register_watches = set()
+        # (pc, address, old, new) for each write that tripped a watch
+        self.hits = []
+
+    def watch_memory(self, start: int, end: int = None):
+        self.memory_watches.append((start, start + 1 if end is None else end))
+
+    def watch_register(self, register: int):
+        self.register_watches.add(register)
+
+    def clear_watches(self):
+        self.memory_watches.clear()
+        self.register_watches.clear()
+
+    def watched(self, n: int, old: int, new: int) -> bool:
+        if n > 32767:
+            return n - 32768 in self.register_watches and old != new
+        return any(start <= n < end for start, end in self.memory_watches)
+
+    def run(self, limit: int = None) -> str:
+        # run until a breakpoint, a watch, a halt, missing input or <limit>
+        # instructions; returns which
+        self.hits.clear()
+        vm = self.vm
+        if not self.breakpoints and not self.memory_watches and not self.register_watches and limit is None:
+            vm.run()
+        else:
+            self.instrumented(limit)
+        if self.hits:
+            return 'watch'
+        if vm.counter in self.breakpoints and vm.running:
+            vm.running = False
+            return 'breakpoint'
+        op = vm.memory[vm.counter]
+        if not vm.running and op == 0:
+            return 'halt'
+        if not vm.running and op == 20:
+            return 'input'
+        vm.running = False
+        return 'step'
+
+    def instrumented(self, limit: Optional[int]):
+        vm = self.vm
+        steps = STEPS
+        memory = vm.memory
+        stack = vm.stack
+        breakpoints = self.breakpoints
+        watching = self.memory_watches or self.register_watches
+        hits = self.hits
+        done = 0
+        pc = vm.counter
+        vm.running = True
+        try:
+            while vm.running and (limit is None or done < limit):
+                # the instruction the run starts on is never a stop, so
+                # continuing from a breakpoint moves past it
+                if done and pc in breakpoints:
+                    break
+                if watching:
+                    n = destination(memory, pc)
+                    old = memory[n] if n != NO_WRITE else 0
+                nxt = steps[memory[pc]](vm, memory, pc, stack)
+                if watching and n != NO_WRITE and nxt != pc and self.watched(n, old, memory[n]):
+                    hits.append((pc, n, old, memory[n]))
+                pc = nxt
+                done += 1
+                if hits:
+                    break
+        finally:
+            vm.counter = pc
+            vm.output.flush()
+
+    def set_register(self, register: int, value: int):
+        self.vm.registers[register] = value
+
+    def poke(self, address: int, values: List[int]):
+        self.vm.memory[address:address + len(values)] = array('H', values)
+        self.vm.memory_written(address, address + len(values))
+        self.vm.memory_reloaded(address, address + len(values))
+
+    def registers(self) -> str:
+        vm = self.vm
+        regs = ' '.join(f'r{i}={v}' for i, v in enumerate(vm.registers))
+        return f'pc={vm.counter} {regs} stack[{len(vm.stack)}]={list(vm.stack[-8:])}'
+
+    def listing(self, address: int, count: int) -> str:
+        lines = []
+        memory = self.vm.memory
+        for _ in range(count):
+            if memory[address] >= len(ARITY):
+                lines.append(f'{address:5}  .data {memory[address]}')
+                address += 1
+                continue
+            mark = '*' if address in self.breakpoints else ' '
+            lines.append(f'{address:5}{mark} {format_instruction(memory, address)}')
+            address += 1 + ARITY[memory[address]]
+        return '\n'.join(lines)
+
+
+HELP = '''b ADDR          set a breakpoint        d ADDR       delete it
+w START [END]   watch memory writes     rw N         watch register N
+unwatch         drop every watch        c            continue
+s [N]           step N instructions     r            registers and stack
+set rN VALUE    edit a register         poke ADDR V  edit memory
+x ADDR [N]      dump memory             l [ADDR] [N] disassemble
+i TEXT          queue a game command    q            quit'''
+
+
+def number(text: str) -> int:
+    return int(text, 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Debug a Synacor binary')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--commands', help='game commands to queue first')
+    args = parser.parse_args()
+    machine = Machine()
+    machine.import_file(Path(args.binary))
+    machine.interactive = False
+    if args.commands:
+        machine.add_commands(Path(args.commands).read_text().splitlines())
+    debugger = Debugger(machine)
+    print(HELP)
+    while True:
+        try:
+            words = shlex.split(input('(debug) '))
+        except EOFError:
+            break
+        if not words:
+            continue
+        command, rest = words[0], words[1:]
+        try:
+            if command == 'q':
+                break
+            elif command == 'b':
+                debugger.breakpoints.add(number(rest[0]))
+            elif command == 'd':
+                debugger.breakpoints.discard(number(rest[0]))
+            elif command == 'w':
+                debugger.watch_memory(*map(number, rest[:2]))
+            elif command == 'rw':
+                debugger.watch_register(number(rest[0]))
+            elif command == 'unwatch':
+                debugger.clear_watches()
+            elif command in ('c', 's'):
+                reason = debugger.run(number(rest[0]) if rest else 1 if command == 's' else None)
+                for pc, address, old, new in debugger.hits:
+                    print(f'\n{address} {old} -> {new} at {pc}')
+                print(f'\n[{reason}] {debugger.registers()}')
+                print(debugger.listing(machine.counter, 1))
+            elif command == 'r':
+                print(debugger.registers())
+            elif command == 'set':
+                debugger.set_register(number(rest[0].lstrip('r')), number(rest[1]))
+            elif command == 'poke':
+                debugger.poke(number(rest[0]), [number(v) for v in rest[1:]])
+            elif command == 'x':
+                start = number(rest[0])
+                print(list(machine.memory[start:start + (number(rest[1]) if len(rest) > 1 else 16)]))
+            elif command == 'l':
+                start = number(rest[0]) if rest else machine.counter
+                print(debugger.listing(start, number(rest[1]) if len(rest) > 1 else 10))
+            elif command == 'i':
+                machine.add_commands([' '.join(rest)])
+            else:
+                print(HELP)
+        except (IndexError, ValueError) as error:
+            print(f'error: {error}')
@@ -0,0 +1,165 @@
+import argparse
+import json
+from pathlib import Path
+from typing import Iterable, Iterator, TextIO
+
+from operations import ARITY, OPCODES, operand_text
+
+# longest run of data words in one listing record
+DATA_RUN = 16
+
+
+def descend(memory, size: int, entries: Iterable[int], code: bytearray, functions: set, targets: set):
+    # recursive descent from <entries>, following fallthrough and literal
+    # jmp/jt/jf/call targets; code[a] is 1 at an instruction and 2 on its
+    # operands, data is whatever stays 0
+    todo = list(entries)
+    while todo:
+        pc = todo.pop()
+        while 0 <= pc < size and not code[pc]:
+            op = memory[pc]
+            if op >= len(ARITY):
+                break
+            nxt = pc + 1 + ARITY[op]
+            args = memory[pc + 1:nxt]
+            if nxt > size or any(x > 32775 for x in args):
+                break
+            code[pc] = 1
+            code[pc + 1:nxt] = b'\x02' * (nxt - pc - 1)
+            if op == 17 and args[0] < 32768:
+                functions.add(args[0])
+                todo.append(args[0])
+            elif op == 6 and args[0] < 32768:
+                targets.add(args[0])
+                todo.append(args[0])
+            elif op in (7, 8) and args[1] < 32768:
+                targets.add(args[1])
+                todo.append(args[1])
+            if op in (0, 6, 18):
+                break
+            pc = nxt
+
+
+def plausible(memory, start: int, size: int, code: bytearray) -> bool:
+    # a linear sweep from <start> through unclaimed words decodes at least
+    # three valid instructions and ends on halt, jmp or ret
+    pc = start
+    count = 0
+    while pc < size and not code[pc]:
+        op = memory[pc]
+        if op >= len(ARITY):
+            return False
+        nxt = pc + 1 + ARITY[op]
+        if nxt > size or any(x > 32775 for x in memory[pc + 1:nxt]):
+            return False
+        count += 1
+        if op in (0, 6, 18):
+            return count >= 3
+        pc = nxt
+    return False
+
+
+def trace_code(memory, size: int, entries: Iterable[int] = (0,), sweep: bool = True):
+    # code reachable from <entries>; with <sweep>, gaps are also linear swept
+    # for routines only reached through register calls and jumps
+    code = bytearray(size)
+    functions = set()
+    targets = set()
+    subroutines = set()
+    descend(memory, size, entries, code, functions, targets)
+    if sweep:
+        for start in range(size):
+            if not code[start] and plausible(memory, start, size, code):
+                subroutines.add(start)
+                descend(memory, size, [start], code, functions, targets)
+    return code, functions, targets, subroutines
+
+
+def label(address: int, functions, targets, subroutines=()) -> str:
+    if address in functions:
+        return f'fn_{address}'
+    if address in subroutines:
+        return f'sub_{address}'
+    if address in targets:
+        return f'L_{address}'
+    return ''
+
+
+def listing(memory, size: int, entries: Iterable[int] = (0,)) -> Iterator[dict]:
+    # one record per instruction and per run of data, in address order
+    code, functions, targets, subroutines = trace_code(memory, size, entries)
+    address = 0
+    while address < size:
+        if code[address] == 1:
+            op = memory[address]
+            opcode = OPCODES[op]
+            args = memory[address + 1:address + 1 + ARITY[op]]
+            record = {
+                'address': address,
+                'kind': 'code',
+                'op': opcode.name,
+                'args': [
+                    operand_text(role, x, lambda t: label(t, functions, targets, subroutines))
+                    for role, x in zip(opcode.roles, args)
+                ],
+            }
+            if op == 19 and args[0] < 128:
+                record['char'] = chr(args[0])
+            name = label(address, functions, targets, subroutines)
+            if name:
+                record['label'] = name
+            yield record
+            address += 1 + len(args)
+        else:
+            start = address
+            while address < size and code[address] == 0 and address - start < DATA_RUN:
+                address += 1
+            words = list(memory[start:address])
+            record = {'address': start, 'kind': 'data', 'words': words}
+            if all(32 <= w < 127 or w == 10 for w in words):
+                record['text'] = ''.join(map(chr, words))
+            yield record
+
+
+def format_record(record: dict) -> str:
+    lines = []
+    if 'label' in record:
+        lines.append(f'{record["address"]:5}  {record["label"]}:')
+    if record['kind'] == 'code':
+        text = ' '.join([record['op']] + [str(x) for x in record['args']])
+        if 'char' in record:
+            text += f'  ; {record["char"]!r}'
+        lines.append(f'{record["address"]:5}      {text}')
+    elif 'text' in record:
+        lines.append(f'{record["address"]:5}      .text {record["text"]!r}')
+    else:
+        lines.append(f'{record["address"]:5}      .data {" ".join(str(w) for w in record["words"])}')
+    return '\n'.join(lines) + '\n'
+
+
+def write(records: Iterable[dict], text: TextIO = None, index: TextIO = None):
+    # stream records out as a human listing and/or JSON lines
+    for record in records:
+        if text is not None:
+            text.write(format_record(record))
+        if index is not None:
+            index.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Disassemble a Synacor binary')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--text', default='challenge.asm', help='human readable listing')
+    parser.add_argument('--json', default='challenge.jsonl', help='machine readable listing')
+    parser.add_argument('--entry', type=int, action='append', default=[0], help='extra entry points')
+    parser.add_argument('--decrypted', action='store_true', help='run up to the first prompt first')
+    args = parser.parse_args()
+    if args.decrypted:
+        from explorer import boot
+        vm = boot(args.binary)
+    else:
+        from vm import VirtualMachine
+        vm = VirtualMachine()
+        vm.import_file(Path(args.binary))
+    with Path(args.text).open('w') as text_file, Path(args.json).open('w') as json_file:
+        write(listing(vm.memory, vm.size, args.entry), text_file, json_file)
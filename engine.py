@@ -0,0 +1,134 @@
+import os
+import weakref
+from functools import partial
+from pathlib import Path
+
+from compiler import VirtualMachineCompiled
+from operations import ARITY, OPCODES, STEPS
+from tracer import NO_WRITE, TraceWriter
+from vm import VirtualMachine, VirtualMachineCached
+
+# per opcode, how its destination is found: 'w' the raw first operand,
+# 's' the value of the first operand, None when nothing is written
+DESTINATIONS = [opcode.roles[0] if opcode.roles[:1] in ('w', 's') else None for opcode in OPCODES]
+
+
+def destination(m, pc: int) -> int:
+    # the address the instruction at <pc> writes, NO_WRITE when none
+    kind = DESTINATIONS[m[pc]]
+    if kind is None:
+        return NO_WRITE
+    a = m[pc + 1]
+    return m[a] if kind == 's' and a > 32767 else a
+
+
+def run_plain(vm):
+    m = vm.memory
+    st = vm.stack
+    steps = STEPS
+    pc = vm.counter
+    try:
+        while vm.running:
+            pc = steps[m[pc]](vm, m, pc, st)
+    finally:
+        vm.counter = pc
+
+
+def run_traced(vm):
+    # every instruction into vm.trace, in the tracer record format
+    m = vm.memory
+    st = vm.stack
+    steps = STEPS
+    trace = vm.trace
+    pc = vm.counter
+    try:
+        while vm.running:
+            op = m[pc]
+            n = ARITY[op]
+            a = b = c = 0
+            if n:
+                a = m[pc + 1]
+                a = m[a] if a > 32767 else a
+                if n > 1:
+                    b = m[pc + 2]
+                    b = m[b] if b > 32767 else b
+                    if n > 2:
+                        c = m[pc + 3]
+                        c = m[c] if c > 32767 else c
+            kind = DESTINATIONS[op]
+            destination = NO_WRITE if kind is None else m[pc + 1] if kind == 'w' else a
+            if not trace.count:
+                vm.counter = pc
+                trace.start(vm.executed, vm.snapshot())
+            nxt = steps[op](vm, m, pc, st)
+            if nxt == pc and op == 20:
+                # stopped waiting for input; the instruction runs again later
+                break
+            trace.add(pc, op, a, b, c, destination, 0 if destination == NO_WRITE else m[destination])
+            vm.executed += 1
+            pc = nxt
+    finally:
+        vm.counter = pc
+
+
+BACKENDS = {
+    'plain': run_plain,
+    'traced': run_traced,
+}
+
+
+class Machine(VirtualMachine):
+    # machine state, snapshots and I/O come from VirtualMachine; execution
+    # goes through the step functions generated from the opcode table, with
+    # the run loop picked by <backend>
+    def __init__(self, backend: str = 'plain', trace: TraceWriter = None):
+        super().__init__()
+        self.backend = BACKENDS[backend]
+        self.trace = trace
+        self.executed = 0
+
+    def run(self):
+        self.running = True
+        try:
+            self.backend(self)
+        finally:
+            self.output.flush()
+
+    def step(self, limit: int = 1) -> int:
+        # as VirtualMachine.step, through the plain step functions whatever
+        # the backend
+        m = self.memory
+        st = self.stack
+        steps = STEPS
+        pc = self.counter
+        done = 0
+        self.running = True
+        try:
+            while self.running and done < limit:
+                pc = steps[m[pc]](self, m, pc, st)
+                done += 1
+        finally:
+            self.counter = pc
+        return done - 1 if self.waiting() else done
+
+
+def traced_machine() -> Machine:
+    # the traced backend writing to nowhere; the writer is closed with the machine
+    trace = TraceWriter(Path(os.devnull))
+    vm = Machine('traced', trace)
+    weakref.finalize(vm, trace.close)
+    return vm
+
+
+# every engine by name, as a factory for a fresh machine
+ENGINES = {
+    'interpreter': VirtualMachine,
+    'cached': VirtualMachineCached,
+    # superinstructions fused the first time an address runs
+    'cached-eager': partial(VirtualMachineCached, 1),
+    'compiled': VirtualMachineCompiled,
+    # every block compiled the first time the run loop reaches it
+    'compiled-eager': partial(VirtualMachineCompiled, 1),
+    'table': Machine,
+    'table-trace': traced_machine,
+}
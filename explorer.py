@@ -0,0 +1,148 @@
+import argparse
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+from compiler import VirtualMachineCompiled
+from vmio import BufferOutput, NullOutput
+
+# codes for the challenge website are 12 letters and digits of mixed case
+CODE = re.compile(r'\b(?=\w*[a-z])(?=\w*[A-Z])[A-Za-z0-9]{12}\b')
+
+# per-process machine and scratch words, set up by init_worker
+vm = None
+scratch = []
+
+
+def boot(binary: str):
+    # load the binary and run it up to the first prompt, diffing later
+    # snapshots against that state
+    machine = VirtualMachineCompiled()
+    machine.import_file(Path(binary))
+    machine.interactive = False
+    machine.output = NullOutput()
+    machine.run()
+    machine.rebase()
+    return machine
+
+
+def play(machine, state: bytes, commands: List[str]) -> str:
+    machine.restore(state)
+    machine.add_commands(commands)
+    machine.output = BufferOutput()
+    machine.run()
+    return machine.output.getvalue()
+
+
+def calibrate(machine, state: bytes) -> List[int]:
+    # words the game uses as line input scratch space; they differ between
+    # states that only differ by which harmless commands were typed
+    play(machine, state, ['look'])
+    reference = machine.memory[:]
+    words = set()
+    for filler in ('inv', 'help', 'x' * 40, 'look ' * 8):
+        play(machine, state, [filler, 'look'])
+        words.update(i for i, (a, b) in enumerate(zip(reference, machine.memory)) if a != b)
+    return sorted(words)
+
+
+def state_hash(machine, scratch_words: List[int]) -> str:
+    memory = machine.memory[:]
+    for i in scratch_words:
+        memory[i] = 0
+    return hashlib.blake2b(memory.tobytes(), digest_size=16).hexdigest()
+
+
+def sections(text: str) -> dict:
+    # map each "heading:" in the game output to the "- item" lines under it
+    found = {}
+    heading = None
+    for line in text.splitlines():
+        if line.startswith('- ') and heading is not None:
+            found[heading].append(line[2:])
+        elif line.endswith(':'):
+            heading = line
+            found[heading] = []
+        else:
+            heading = None
+    return found
+
+
+def room(text: str) -> str:
+    titles = re.findall(r'^== (.+) ==$', text, re.M)
+    return titles[-1] if titles else ''
+
+
+def candidates(text: str) -> List[str]:
+    commands = []
+    for heading, items in sections(text).items():
+        if 'exit' in heading:
+            commands.extend(f'go {x}' for x in items)
+        elif heading.startswith('Things of interest'):
+            commands.extend(f'take {x}' for x in items)
+        elif heading.startswith('Your inventory'):
+            commands.extend(f'use {x}' for x in items)
+    return commands
+
+
+def init_worker(binary: str, scratch_words: List[int]):
+    global vm, scratch
+    vm = boot(binary)
+    scratch = scratch_words
+
+
+def expand(state: bytes, command: str):
+    text = play(vm, state, [command])
+    halted = vm.memory[vm.counter] != 20
+    new_state = vm.snapshot()
+    key = state_hash(vm, scratch)
+    look = '' if halted else play(vm, new_state, ['look', 'inv'])
+    return new_state, key, text, look, halted
+
+
+def explore(binary: str, depth: int, workers: int = None):
+    workers = workers or os.cpu_count()
+    machine = boot(binary)
+    root = machine.snapshot()
+    scratch_words = calibrate(machine, root)
+    machine.restore(root)
+    seen = {state_hash(machine, scratch_words)}
+    look = play(machine, root, ['look', 'inv'])
+    rooms = {room(look): []}
+    codes = {}
+    frontier = [(root, [], look)]
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(binary, scratch_words)) as pool:
+        for _ in range(depth):
+            jobs = [(state, path, command) for state, path, look in frontier for command in candidates(look)]
+            if not jobs:
+                break
+            chunk = max(1, len(jobs) // (4 * workers))
+            results = pool.map(expand, [j[0] for j in jobs], [j[2] for j in jobs], chunksize=chunk)
+            frontier = []
+            for (state, path, command), (new_state, key, text, look, halted) in zip(jobs, results):
+                path = path + [command]
+                for code in CODE.findall(text):
+                    codes.setdefault(code, path)
+                if halted or key in seen:
+                    continue
+                seen.add(key)
+                rooms.setdefault(room(look), path)
+                frontier.append((new_state, path, look))
+    return rooms, codes, len(seen)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Breadth-first search of the text adventure')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    found_rooms, found_codes, states = explore(args.binary, args.depth, args.workers)
+    print(f'{states} distinct states')
+    for name, route in found_rooms.items():
+        print(f'{name}: {"; ".join(route)}')
+    for code, route in found_codes.items():
+        print(f'code {code}: {"; ".join(route)}')
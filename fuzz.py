@@ -0,0 +1,339 @@
+import argparse
+import fnmatch
+import os
+import random
+import signal
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from batch import HALTED, WAITING, BatchMachine
+from engine import ENGINES, Machine
+from operations import ARITY, OPCODES, PURE, format_instruction
+from vm import VirtualMachine
+from vmio import BufferOutput
+
+# instructions per generated program, before the closing halt
+LENGTH = 24
+# random data words placed after the program
+DATA_WORDS = 16
+# cases the reference takes longer than this many steps on are dropped
+STEP_LIMIT = 2000
+# seconds an engine may run one case before it counts as hung
+TIMEOUT = 2.0
+# seeds handed to a worker at a time
+CHUNK = 200
+# literals where arithmetic tends to go wrong
+EDGES = [0, 1, 2, 7, 255, 256, 16383, 16384, 32766, 32767]
+# iterations of a generated counted loop; enough for the cached engine to
+# fuse its body
+LOOP_COUNTS = (16, 40)
+# most instructions in the body of a counted loop
+LOOP_BODY = 5
+
+
+class Case(NamedTuple):
+    seed: int
+    words: List[int]
+    registers: List[int]
+    stack: List[int]
+    # pending input characters
+    text: str
+    counter: int = 0
+
+
+class Outcome(NamedTuple):
+    stop: str
+    counter: int
+    registers: Tuple[int, ...]
+    stack: Tuple[int, ...]
+    memory: bytes
+    output: str
+
+
+class Hung(Exception):
+    pass
+
+
+def generate(seed: int, length: int = LENGTH) -> Case:
+    # a random program from address 0, closed by a halt and followed by
+    # random data, and a random machine state to start it in. Operands lean
+    # towards registers, edge values and addresses inside the program, so
+    # jumps, rmem and wmem land on code and data that matter. Half the
+    # programs hold a counted loop of register arithmetic closed by a
+    # backward jt or jf, which runs hot enough to be fused
+    rng = random.Random(seed)
+    ops = [rng.randrange(len(OPCODES)) if rng.random() > 0.02 else 0 for _ in range(length)]
+    # instruction index -> fixed operands, the loop body's indices and the
+    # registers the body must not write
+    fixed = {}
+    writers = range(0)
+    counters = set()
+    body = rng.randrange(1, LOOP_BODY + 1)
+    if rng.random() < 0.5 and length >= body + 4:
+        first = rng.randrange(length - body - 3)
+        writers = range(first + 1, first + 1 + body)
+        counter, flag = rng.sample(range(32768, 32776), 2)
+        counters = {counter, flag}
+        ops[first] = 1
+        fixed[first] = [counter, rng.randrange(*LOOP_COUNTS)]
+        ops[first + 1:first + 1 + body] = [rng.choice(list(PURE)) for _ in range(body)]
+        last = writers.stop
+        ops[last] = 9
+        fixed[last] = [counter, counter, 32767]
+        if rng.random() < 0.5:
+            ops[last + 1] = 7
+            fixed[last + 1] = [counter, None]
+        else:
+            ops[last + 1] = 4
+            fixed[last + 1] = [flag, counter, 0]
+            ops[last + 2] = 8
+            fixed[last + 2] = [flag, None]
+    starts = []
+    address = 0
+    for op in ops:
+        starts.append(address)
+        address += 1 + ARITY[op]
+    end = address
+    data = list(range(end + 1, end + 1 + DATA_WORDS))
+    targets = starts + [end]
+
+    def value() -> int:
+        kind = rng.random()
+        if kind < 0.4:
+            return 32768 + rng.randrange(8)
+        if kind < 0.6:
+            return rng.choice(targets + data)
+        if kind < 0.8:
+            return rng.choice(EDGES)
+        return rng.randrange(32768)
+
+    by_arity = {}
+    for op in range(len(OPCODES)):
+        by_arity.setdefault(ARITY[op], []).append(op)
+    if fixed:
+        # the backward jump goes to the first instruction of the body
+        fixed[max(fixed)][1] = starts[writers.start]
+    registers = [r for r in range(32768, 32776) if r not in counters]
+    words = []
+    for i, op in enumerate(ops):
+        words.append(op)
+        if i in fixed:
+            words += fixed[i]
+            continue
+        if op == 16 and rng.random() < 0.5:
+            # self-modifying code that stays decodable: an opcode of the
+            # same length over an opcode, or any operand over an operand
+            address = rng.randrange(end)
+            if address in starts:
+                words += [address, rng.choice(by_arity[ARITY[ops[starts.index(address)]]])]
+            else:
+                words += [address, value()]
+            continue
+        for role in OPCODES[op].roles:
+            if role == 'w' and i in writers:
+                words.append(rng.choice(registers))
+            elif role == 'w':
+                # mostly a register, sometimes a literal address
+                words.append(32768 + rng.randrange(8) if rng.random() < 0.9 else value())
+            elif role == 'j' and rng.random() < 0.8:
+                # mostly forward, so most programs finish
+                words.append(rng.choice(targets[i + 1:]) if rng.random() < 0.8 else rng.choice(targets))
+            else:
+                words.append(value())
+    words.append(0)
+    words += [rng.randrange(32768) for _ in data]
+    registers = [rng.choice(targets + data + EDGES) for _ in range(8)]
+    stack = [rng.choice(targets) for _ in range(rng.randrange(4))]
+    text = ''.join(''.join(rng.choice('abc ') for _ in range(rng.randrange(4))) + '\n' for _ in range(2))
+    return Case(seed, words, registers, stack, text)
+
+
+def load(vm: VirtualMachine, case: Case) -> VirtualMachine:
+    vm.memory[:len(case.words)] = array('H', case.words)
+    vm.size = len(case.words)
+    vm.rebase()
+    vm.registers[:] = array('H', case.registers)
+    vm.stack.reset(case.stack)
+    vm.counter = case.counter
+    vm.input_buffer = deque(case.text)
+    vm.interactive = False
+    vm.output = BufferOutput()
+    return vm
+
+
+def outcome(vm: VirtualMachine, stop: str, output: str) -> Outcome:
+    return Outcome(stop, vm.counter, tuple(vm.registers), tuple(vm.stack), vm.memory.tobytes(), output)
+
+
+def valid(memory, pc: int, stack) -> bool:
+    # whether the spec defines what the instruction at <pc> does
+    op = memory[pc]
+    if op >= len(OPCODES) or pc + ARITY[op] > 32767:
+        return False
+    args = memory[pc + 1:pc + 1 + ARITY[op]]
+    if any(x > 32775 for x in args):
+        return False
+    values = [memory[x] if x > 32767 else x for x in args]
+    if op == 11:
+        return values[2] != 0
+    if op == 15:
+        # a code word holding a register operand is not a value
+        return memory[values[1]] < 32768
+    return op != 3 or len(stack) > 0
+
+
+def reference(case: Case) -> Optional[Tuple[Outcome, List[int]]]:
+    # the outcome of the table's step functions and the addresses they ran,
+    # one instruction at a time; None for cases that leave the spec or run too long
+    vm = load(Machine(), case)
+    memory = vm.memory
+    trace = []
+    vm.running = True
+    while vm.running:
+        if len(trace) == STEP_LIMIT or not valid(memory, vm.counter, vm.stack):
+            return None
+        trace.append(vm.counter)
+        vm.step()
+    stop = 'input' if memory[vm.counter] == 20 else 'halt'
+    return outcome(vm, stop, vm.output.getvalue()), trace
+
+
+def run_batch(case: Case) -> Outcome:
+    batch = BatchMachine.from_vm(load(VirtualMachine(), case), 1)
+    batch.run()
+    status = batch.status[0]
+    stop = 'halt' if status == HALTED else 'input' if status == WAITING else 'fault'
+    return outcome(batch.lane(0), stop, batch.text(0))
+
+
+def run_engine(factory: Callable, case: Case) -> Outcome:
+    if factory is None:
+        return run_batch(case)
+    vm = load(factory(), case)
+    vm.run()
+    stop = 'input' if vm.memory[vm.counter] == 20 else 'halt'
+    return outcome(vm, stop, vm.output.getvalue())
+
+
+def on_alarm(signum, frame):
+    raise Hung()
+
+
+def guarded(factory: Callable, case: Case) -> Outcome:
+    # the engine's outcome, or a stand-in naming the exception it raised
+    signal.setitimer(signal.ITIMER_REAL, TIMEOUT)
+    try:
+        return run_engine(factory, case)
+    except Hung:
+        return Outcome('hung', -1, (), (), b'', '')
+    except Exception as error:
+        return Outcome(f'raised {type(error).__name__}: {error}', -1, (), (), b'', '')
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def difference(expected: Outcome, got: Outcome) -> Optional[str]:
+    for field in Outcome._fields:
+        want, have = getattr(expected, field), getattr(got, field)
+        if want == have:
+            continue
+        if field == 'memory':
+            at = next(i for i in range(0, len(want), 2) if want[i:i + 2] != have[i:i + 2]) // 2
+            return f'memory[{at}] {want[2 * at] | want[2 * at + 1] << 8} != {have[2 * at] | have[2 * at + 1] << 8}'
+        return f'{field} {want!r} != {have!r}'
+    return None
+
+
+def cut(case: Case, address: int) -> Case:
+    # <case> with a halt written over <address>
+    words = list(case.words) + [0] * max(0, address + 1 - len(case.words))
+    words[address] = 0
+    return case._replace(words=words)
+
+
+def first_divergence(factory: Callable, case: Case, trace: List[int]) -> str:
+    # where the engine first goes wrong. In lockstep with the reference,
+    # each instruction is run alone on a fresh engine from the reference
+    # state before it, stopped by a halt over the next address; a bug that
+    # needs the engine's caches to show up survives that, so it is then
+    # bracketed by cutting the whole program short at each new address
+    vm = load(Machine(), case)
+    memory = vm.memory
+    for step, pc in enumerate(trace[:-1]):
+        state = Case(case.seed, memory[:32768].tolist(), list(vm.registers), list(vm.stack),
+                     ''.join(vm.input_buffer), pc)
+        single = cut(state, trace[step + 1])
+        expected = reference(single)
+        if expected is not None and difference(expected[0], guarded(factory, single)) is not None:
+            return f'step {step} at {pc}: {format_instruction(memory, pc)}'
+        vm.step()
+    agreed = 0
+    seen = set()
+    for step, pc in enumerate(trace):
+        if pc in seen:
+            continue
+        seen.add(pc)
+        if difference(reference(cut(case, pc))[0], guarded(factory, cut(case, pc))) is not None:
+            return f'only in context, between steps {agreed} and {step}'
+        agreed = step
+    return f'only in context, after step {agreed}'
+
+
+def check(seeds: range, names: List[str]) -> Tuple[int, int, List[str]]:
+    # (cases run, cases dropped, a report per divergence) for <seeds>
+    signal.signal(signal.SIGALRM, on_alarm)
+    factories = {name: all_engines()[name] for name in names}
+    run = dropped = 0
+    reports = []
+    for seed in seeds:
+        case = generate(seed)
+        expected = reference(case)
+        if expected is None:
+            dropped += 1
+            continue
+        run += 1
+        for name, factory in factories.items():
+            problem = difference(expected[0], guarded(factory, case))
+            if problem is None:
+                continue
+            reports.append(f'seed {seed}: {name}: {problem}; {first_divergence(factory, case, expected[1])}')
+    return run, dropped, reports
+
+
+def all_engines() -> Dict[str, Optional[Callable]]:
+    # every engine but the plain table engine the reference runs on; batch
+    # has no factory
+    names = {name: factory for name, factory in ENGINES.items() if name != 'table'}
+    names['batch'] = None
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Differential fuzzing of every engine against the opcode table')
+    parser.add_argument('--cases', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0, help='first seed; case n uses seed + n')
+    parser.add_argument('--engines', default='*', help='comma separated fnmatch patterns')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk', type=int, default=CHUNK)
+    args = parser.parse_args()
+    patterns = args.engines.split(',')
+    names = [n for n in all_engines() if any(fnmatch.fnmatch(n, p) for p in patterns)]
+    chunks = [range(s, min(s + args.chunk, args.seed + args.cases))
+              for s in range(args.seed, args.seed + args.cases, args.chunk)]
+    start = time.perf_counter()
+    total = dropped = 0
+    reports = []
+    with ProcessPoolExecutor(args.workers or os.cpu_count()) as pool:
+        for run, skipped, found in pool.map(check, chunks, [names] * len(chunks)):
+            total += run
+            dropped += skipped
+            reports += found
+    elapsed = time.perf_counter() - start
+    for report in reports:
+        print(report)
+    print(f'{total} cases on {", ".join(names)} in {elapsed:.1f}s ({total / elapsed:.0f}/s), '
+          f'{dropped} dropped, {len(reports)} divergences')
+    raise SystemExit(1 if reports else 0)
@@ -0,0 +1,121 @@
+import argparse
+import os
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+from compiler import VirtualMachineCompiled
+from vm import VirtualMachine
+
+# input lines between checkpoints
+CHECKPOINT_COMMANDS = 50
+# seconds after which the next line checkpoints even with fewer lines
+CHECKPOINT_SECONDS = 60.0
+# checkpoints kept; older ones are deleted as new ones land
+KEEP = 2
+
+
+def durable_write(path: Path, data: bytes):
+    partial = path.with_suffix('.tmp')
+    with partial.open('wb') as state_file:
+        state_file.write(data)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(partial, path)
+
+
+class Journal:
+    # every input line a machine is given, appended to <directory>/inputs.log
+    # and synced before the machine reads it, plus snapshots taken between
+    # lines named after the number of lines read before them, so a batch of
+    # queued commands is checkpointed as it is read
+    def __init__(self, directory: Path, every: int = CHECKPOINT_COMMANDS, interval: float = CHECKPOINT_SECONDS):
+        self.directory = directory
+        self.every = every
+        self.interval = interval
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / 'inputs.log'
+        data = self.path.read_bytes() if self.path.exists() else b''
+        if data and not data.endswith(b'\n'):
+            # a line torn by a crash was never read by the machine
+            data = data[:data.rfind(b'\n') + 1]
+            os.truncate(self.path, len(data))
+        self.lines = data.decode().splitlines()
+        self.file = self.path.open('a')
+        # lines the machine has read to their end
+        self.consumed = 0
+        self.between_lines = True
+        self.checkpointed = 0
+        self.last_checkpoint = time.monotonic()
+
+    def record(self, line: str):
+        self.file.write(line.rstrip('\n') + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lines.append(line.rstrip('\n'))
+
+    def checkpoints(self) -> List[Tuple[int, Path]]:
+        # (lines included, path), oldest first
+        return sorted((int(p.stem.split('-')[1]), p) for p in self.directory.glob('checkpoint-*.state'))
+
+    def read(self, char: str):
+        # called for every character the machine reads
+        self.between_lines = char == '\n'
+        if self.between_lines:
+            self.consumed += 1
+
+    def next_line(self, vm: VirtualMachine):
+        # called when the machine is about to read a line, queued or typed
+        due = self.consumed - self.checkpointed >= self.every
+        late = time.monotonic() - self.last_checkpoint >= self.interval
+        if self.consumed > self.checkpointed and (due or late):
+            self.checkpoint(vm)
+
+    def checkpoint(self, vm: VirtualMachine):
+        durable_write(self.directory / f'checkpoint-{self.consumed:09}.state', vm.snapshot())
+        self.checkpointed = self.consumed
+        self.last_checkpoint = time.monotonic()
+        for _, old in self.checkpoints()[:-KEEP]:
+            old.unlink()
+
+    def resume(self, vm: VirtualMachine) -> int:
+        # restore the newest checkpoint, queue the lines recorded after it and
+        # start journaling <vm>; returns how many lines are replayed
+        found = self.checkpoints()
+        if found:
+            self.checkpointed, path = found[-1]
+            vm.restore(path.read_bytes())
+            # lines still queued when it was taken are replayed from the log
+            vm.input_buffer.clear()
+        self.consumed = self.checkpointed
+        self.between_lines = True
+        vm.add_commands(self.lines[self.checkpointed:])
+        vm.journal = self
+        return len(self.lines) - self.checkpointed
+
+    def close(self):
+        self.file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play a Synacor binary with a crash-safe input journal')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--journal', default='journal', help='directory holding the journal and checkpoints')
+    parser.add_argument('--commands', help='commands to queue first when the journal is new')
+    parser.add_argument('--every', type=int, default=CHECKPOINT_COMMANDS, help='input lines between checkpoints')
+    parser.add_argument('--interval', type=float, default=CHECKPOINT_SECONDS, help='seconds between checkpoints')
+    args = parser.parse_args()
+    vm = VirtualMachineCompiled()
+    vm.import_file(Path(args.binary))
+    journal = Journal(Path(args.journal), args.every, args.interval)
+    fresh = not journal.lines
+    replayed = journal.resume(vm)
+    print(f'resumed at line {journal.checkpointed}, replaying {replayed} of {len(journal.lines)}')
+    if fresh and args.commands:
+        vm.add_commands(Path(args.commands).read_text().splitlines())
+    try:
+        vm.run()
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        journal.close()
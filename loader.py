@@ -0,0 +1,79 @@
+import argparse
+import mmap
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+# words a binary may hold; the spec makes 32776..65535 invalid everywhere
+INVALID = 32776
+# the address space a binary is loaded into
+ADDRESSES = 32768
+# validated images kept mapped, keyed by path, inode, size and modification time
+CACHED_IMAGES = 64
+
+
+class InvalidImage(ValueError):
+    def __init__(self, path: Path, message: str, addresses: np.ndarray = None):
+        self.path = path
+        # addresses of the offending words, when the problem is their values
+        self.addresses = np.array([], dtype=int) if addresses is None else addresses
+        shown = ', '.join(map(str, self.addresses[:10]))
+        more = f' and {len(self.addresses) - 10} more' if len(self.addresses) > 10 else ''
+        super().__init__(f'{path}: {message}' + (f' at {shown}{more}' if len(self.addresses) else ''))
+
+
+def map_words(path: Path) -> np.ndarray:
+    # the file as a read-only little-endian word view of its mapping,
+    # without copying; the mapping lives as long as the view
+    size = path.stat().st_size
+    if size % 2:
+        raise InvalidImage(path, f'odd length of {size} bytes')
+    if size == 0:
+        return np.zeros(0, dtype='<u2')
+    with path.open('rb') as image_file:
+        blob = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(blob, dtype='<u2')
+
+
+def invalid_words(words: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(words >= INVALID)
+
+
+def validate(path: Path, words: np.ndarray):
+    if len(words) > ADDRESSES:
+        raise InvalidImage(path, f'{len(words)} words do not fit the {ADDRESSES} word address space')
+    bad = invalid_words(words)
+    if len(bad):
+        raise InvalidImage(path, 'invalid values', bad)
+
+
+@lru_cache(maxsize=CACHED_IMAGES)
+def mapped(path: Path, inode: tuple, size: int, mtime: int) -> np.ndarray:
+    words = map_words(path)
+    validate(path, words)
+    return words
+
+
+def load_image(path: Path) -> np.ndarray:
+    # the validated words of the binary at <path>, mapped once per version
+    # of the file, so loading the same image again costs a stat call
+    info = os.stat(path)
+    return mapped(Path(path), (info.st_dev, info.st_ino), info.st_size, info.st_mtime_ns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check Synacor binaries for invalid words')
+    parser.add_argument('binaries', nargs='*', default=['challenge.bin'])
+    args = parser.parse_args()
+    failed = False
+    for name in args.binaries:
+        try:
+            words = load_image(Path(name))
+        except (InvalidImage, OSError) as error:
+            print(error)
+            failed = True
+        else:
+            print(f'{name}: {len(words)} words, valid')
+    raise SystemExit(1 if failed else 0)
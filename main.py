@@ -1,14 +1,35 @@
-import struct
+import argparse
 from pathlib import Path
-from typing import List
-from vm import VirtualMachine, VirtualMachineDis
+from engine import Machine
+from journal import Journal
+from tracer import TraceWriter
 
 
-commands = Path('bot_commands.txt').open().readlines()
+commands = Path('bot_commands.txt').read_text().splitlines()
 
 if __name__ == '__main__':
-    vm = VirtualMachineDis()
+    parser = argparse.ArgumentParser(description='Play challenge.bin with the bot commands queued')
+    parser.add_argument('--trace', help='record an execution trace to this file')
+    parser.add_argument('--journal', help='record every input line to this directory, resuming from it if it has any')
+    args = parser.parse_args()
+    trace = TraceWriter(Path(args.trace)) if args.trace else None
+    vm = Machine('traced' if trace else 'plain', trace)
     vm.import_file(Path('challenge.bin'))
-    vm.add_commands(commands)
-    vm.run()
-
+    journal = Journal(Path(args.journal)) if args.journal else None
+    # a journal with lines already holds the bot commands
+    if journal is not None and journal.lines:
+        replayed = journal.resume(vm)
+        print(f'resumed at line {journal.checkpointed}, replaying {replayed} of {len(journal.lines)}')
+    else:
+        if journal is not None:
+            journal.resume(vm)
+        vm.add_commands(commands)
+    try:
+        vm.run()
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if trace:
+            trace.close()
+        if journal is not None:
+            journal.close()
@@ -1,228 +1,157 @@
-def num_or_value_from_reg(n, regs):
-    if n > 32767:
-        return regs[n - 32768]
-    return n
-
-
-def out(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c+1], regs)
-    print(chr(a), end='')
-    return memory, p_c + 2, regs, st
-
-
-def add(memory, p_c, regs, st):
-    a = memory[p_c+1]
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    c = num_or_value_from_reg(memory[p_c+3], regs)
-    result = (b + c) % 32768
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c + 4, regs, st
-
-
-def set_opr(memory, p_c, regs, st):
-    a = memory[p_c+1] - 32768
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    regs[a] = b
-    # print(a,b,regs)
-    return memory, p_c + 3, regs, st
-
-
-def noop(memory, p_c, regs, st):
-    return memory, p_c+1, regs, st
-
-
-def jmp(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c + 1], regs)
-    return memory, a, regs, st
-
-
-def jt(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c+1], regs)
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    dest = p_c + 3
-    if a != 0:
-        dest = b
-    return memory, dest, regs, st
-
-
-def jf(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c+1], regs)
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    dest = p_c + 3
-    if a == 0:
-        dest = b
-    return memory, dest, regs, st
-
-
-def do_quit(*args):
-    print()
-    print(args[1])
-    quit()
-
-
-def eq(memory, p_c, regs, st):
-    a = memory[p_c + 1]
-    b = num_or_value_from_reg(memory[p_c + 2], regs)
-    c = num_or_value_from_reg(memory[p_c + 3], regs)
-    # print(memory[p_c], memory[p_c+1], memory[p_c+2], memory[p_c+3])
-    if b == c:
-        result = 1
-    else:
-        result = 0
-
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+4, regs, st
-
-
-def push(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c + 1], regs)
-    st.append(a)
-    return memory, p_c+2, regs, st
-
-
-def pop(memory, p_c, regs, st):
-    a = memory[p_c+1]
-    result = st.pop()
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+2, regs, st
-
-
-def gt(memory, p_c, regs, st):
-    a = memory[p_c+1]
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    c = num_or_value_from_reg(memory[p_c+3], regs)
-    result = 0
-    if b > c:
-        result = 1
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+4, regs, st
-
-
-def and_opr(memory, p_c, regs, st):
-    a = memory[p_c+1]
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    c = num_or_value_from_reg(memory[p_c+3], regs)
-    result = b & c
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+4, regs, st
-
-
-def or_opr(memory, p_c, regs, st):
-    a = memory[p_c+1]
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    c = num_or_value_from_reg(memory[p_c+3], regs)
-    result = b | c
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+4, regs, st
-
-
-def not_opr(memory, p_c, regs, st):
-    a = memory[p_c + 1]
-    b = num_or_value_from_reg(memory[p_c + 2], regs)
-    result = ~b % 32768
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+3, regs, st
-
-
-def call(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c + 1], regs)
-    st.append(p_c+2)
-    return memory, a, regs, st
-
-
-def mult(memory, p_c, regs, st):
-    a = memory[p_c + 1]
-    b = num_or_value_from_reg(memory[p_c + 2], regs)
-    c = num_or_value_from_reg(memory[p_c + 3], regs)
-    result = (b * c) % 32768
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c + 4, regs, st
-
-
-def mod(memory, p_c, regs, st):
-    a = memory[p_c + 1]
-    b = num_or_value_from_reg(memory[p_c + 2], regs)
-    c = num_or_value_from_reg(memory[p_c + 3], regs)
-    result = b % c
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c + 4, regs, st
-
-
-def rmem(memory, p_c, regs, st):
-    a = memory[p_c + 1]
-    b = num_or_value_from_reg(memory[p_c + 2], regs)
-    result = memory[b]
-    regs[a - 32768] = result
-    return memory, p_c+3, regs, st
-
-
-def wmem(memory, p_c, regs, st):
-    a = num_or_value_from_reg(memory[p_c+1], regs)
-    b = num_or_value_from_reg(memory[p_c+2], regs)
-    result = b
-    if a > 32767:
-        regs[a - 32768] = result
-    else:
-        memory[a] = result
-    return memory, p_c+3, regs, st
-
-
-def ret(memory, p_c, regs, st):
-    dest = st.pop()
-    return memory, dest, regs, st
-
-
-def in_opr(memory, p_c, regs, st):
-    return memory, p_c+1, regs, st
-
-operations = {
-    0: do_quit,
-    1: set_opr,
-    2: push,
-    3: pop,
-    4: eq,
-    5: gt,
-    6: jmp,
-    7: jt,
-    8: jf,
-    9: add,
-    10: mult,
-    11: mod,
-    12: and_opr,
-    13: or_opr,
-    14: not_opr,
-    15: rmem,
-    16: wmem,
-    17: call,
-    18: ret,
-    19: out,
-    20: in_opr,
-    21: noop,
-}
\ No newline at end of file
+import re
+from typing import Callable, Dict, List, NamedTuple, Sequence
+
+from stack import StackUnderflow
+
+# memory is tracked for snapshots in pages of 1 << PAGE_BITS words
+PAGE_BITS = 8
+
+
+class Opcode(NamedTuple):
+    name: str
+    # one letter per operand:
+    #   w  register or address the result is written to
+    #   r  value read
+    #   j  jump target value
+    #   a  address read from
+    #   s  address stored to
+    roles: str
+    # python lines run first; operands are a, b, c with every role but w
+    # already resolved to its value, m is memory, st the stack, nxt the
+    # address after the instruction
+    effect: Sequence[str] = ()
+    # expression stored into operand a: the register or address for w
+    # roles, the address it holds for s roles
+    value: str = None
+    # expression for the next pc, nxt when None
+    jump: str = None
+
+
+OPCODES = [
+    Opcode('halt', '', ['vm.running = False'], jump='pc'),
+    Opcode('set', 'wr', value='b'),
+    Opcode('push', 'r', ['st.append(a)']),
+    Opcode('pop', 'w', [
+        'if not st:',
+        "    raise StackUnderflow(f'pop from an empty stack at {pc}')",
+    ], value='st.pop()'),
+    Opcode('eq', 'wrr', value='(b == c) * 1'),
+    Opcode('gt', 'wrr', value='(b > c) * 1'),
+    Opcode('jmp', 'j', jump='a'),
+    Opcode('jt', 'rj', jump='b if a else nxt'),
+    Opcode('jf', 'rj', jump='nxt if a else b'),
+    Opcode('add', 'wrr', value='(b + c) % 32768'),
+    Opcode('mult', 'wrr', value='(b * c) % 32768'),
+    Opcode('mod', 'wrr', value='b % c'),
+    Opcode('and', 'wrr', value='b & c'),
+    Opcode('or', 'wrr', value='b | c'),
+    Opcode('not', 'wr', value='b ^ 32767'),
+    Opcode('rmem', 'wa', value='m[b]'),
+    Opcode('wmem', 'sr', value='b'),
+    Opcode('call', 'j', [
+        'if a in vm.accelerated:',
+        '    vm.accelerated[a](vm)',
+        '    return nxt',
+        'st.call(nxt, a)',
+    ], jump='a'),
+    Opcode('ret', '', [
+        'r = st.ret()',
+        'if r is None:',
+        '    vm.running = False',
+        '    return pc',
+    ], jump='r'),
+    Opcode('out', 'r', ['vm.output.write(chr(a))']),
+    Opcode('in', 'w', [
+        # a journal may snapshot the machine while it waits for input
+        'vm.counter = pc',
+        'v = vm.read_char()',
+        'if v is None:',
+        '    vm.running = False',
+        '    return pc',
+    ], value='v'),
+    Opcode('noop', ''),
+]
+
+NAMES = [opcode.name for opcode in OPCODES]
+ARITY = [len(opcode.roles) for opcode in OPCODES]
+
+
+def source(opcode: Opcode, decoded: bool = False, checked: bool = False) -> str:
+    # a step function (vm, m, pc, st) -> next pc for the 32776 word layout,
+    # where registers are the last eight memory words. A decoded one is
+    # (vm, m, pc, st, ops, nxt), given the raw operand words and the next
+    # address ahead of time; a checked one stores to memory through
+    # vm.set_value, so machines caching code see every write; the others mark
+    # the page of each memory write in vm.dirty themselves
+    name = f'{"c" if decoded else "op"}_{opcode.name}'
+    lines = [f'def {name}(vm, m, pc, st{", ops, nxt" if decoded else ""}):']
+    if decoded and opcode.roles:
+        names = ', '.join('abc'[:len(opcode.roles)])
+        lines.append(f'    {names}{"," if len(opcode.roles) == 1 else ""} = ops')
+    for i, role in enumerate(opcode.roles):
+        x = 'abc'[i]
+        if not decoded:
+            lines.append(f'    {x} = m[pc + {i + 1}]')
+        if role != 'w':
+            lines.append(f'    if {x} > 32767: {x} = m[{x}]')
+    if not decoded:
+        lines.append(f'    nxt = pc + {len(opcode.roles) + 1}')
+    lines.extend(f'    {line}' for line in opcode.effect)
+    if opcode.value is not None and checked:
+        lines.append(f'    v = {opcode.value}')
+        lines.append('    if a > 32767: m[a] = v')
+        lines.append('    else: vm.set_value(a, v)')
+    elif opcode.value is not None:
+        lines.append(f'    m[a] = {opcode.value}')
+        if opcode.roles[0] == 's':
+            lines.append(f'    vm.dirty[a >> {PAGE_BITS}] = 1')
+        else:
+            lines.append(f'    if a < 32768: vm.dirty[a >> {PAGE_BITS}] = 1')
+    lines.append(f'    return {opcode.jump or "nxt"}')
+    return '\n'.join(lines) + '\n'
+
+
+def build(decoded: bool = False, checked: bool = False) -> List[Callable]:
+    steps = []
+    for opcode in OPCODES:
+        namespace = {'StackUnderflow': StackUnderflow}
+        exec(compile(source(opcode, decoded, checked), f'<{opcode.name}>', 'exec'), namespace)
+        steps.append(namespace[f'{"c" if decoded else "op"}_{opcode.name}'])
+    return steps
+
+
+def substitute(line: str, names: Dict[str, str]) -> str:
+    # <line> of an opcode's python with its operand names, nxt and pc
+    # replaced by the expressions in <names>
+    return re.sub(r'\b(a|b|c|nxt|pc)\b', lambda match: names.get(match[0], match[0]), line)
+
+
+STEPS = build()
+# the same with memory writes through vm.set_value, for machines caching code
+CHECKED_STEPS = build(checked=True)
+# checked, with the operands decoded ahead of time
+DECODED_STEPS = build(decoded=True, checked=True)
+operations = dict(enumerate(STEPS))
+# opcodes whose whole effect is storing a function of their read operands,
+# as opcode -> f(b, c); the expressions hold for numpy arrays too
+PURE = {
+    op: eval(f'lambda b, c=0: {opcode.value}')
+    for op, opcode in enumerate(OPCODES) if opcode.roles in ('wr', 'wrr') and not opcode.effect
+}
+
+
+def operand_text(role: str, x: int, label: Callable = None) -> str:
+    if x > 32767:
+        return f'r{x - 32768}'
+    if role == 'j' and label is not None:
+        return label(x) or str(x)
+    return str(x)
+
+
+def format_instruction(memory, address: int, label: Callable = None) -> str:
+    opcode = OPCODES[memory[address]]
+    args = memory[address + 1:address + 1 + len(opcode.roles)]
+    text = ' '.join([opcode.name] + [operand_text(r, x, label) for r, x in zip(opcode.roles, args)])
+    if opcode.name == 'out' and args[0] < 128:
+        text += f'  ; {chr(args[0])!r}'
+    return text
@@ -0,0 +1,177 @@
+import argparse
+from collections import Counter
+from pathlib import Path
+from typing import List, TextIO, Tuple
+
+from engine import ENGINES
+from operations import NAMES
+from stack import InstrumentedStack
+from vm import VirtualMachine
+from vmio import NullOutput
+
+# instructions between samples
+INTERVAL = 1009
+# innermost frames kept per sampled stack, so deep recursion stays bounded
+MAX_FRAMES = 32
+
+
+class Profile:
+    # samples a machine of any engine every <interval> instructions. The
+    # machine runs through step() in slices of <interval>, at its engine's
+    # own speed, and each slice is one sample of the instruction and call
+    # stack it starts at, weighted by the instructions it ran, so the counts
+    # add up to what was run; an interval of 1 counts every instruction
+    # exactly. The call stack is read off the guest stack at each sample, as
+    # the calls its return addresses follow, so calls and rets cost nothing
+    # extra. <exact> installs an InstrumentedStack instead, whose frames
+    # give exact call counts, recursion depths and stack peak, at a cost on
+    # every call and ret.
+    # The overhead on the walkthrough, against a plain run of the engine:
+    #   interval   interpreter   cached   compiled
+    #         97          12%      30%      146%
+    #       1009           2%       6%       25%
+    #      10007           0%       3%       11%
+    # and with <exact> at 1009, 24%, 41% and 106%. The compiled engine pays
+    # most, as it steps the end of every block the interval falls inside
+    # one instruction at a time
+    def __init__(self, vm: VirtualMachine, interval: int = INTERVAL, exact: bool = False):
+        self.vm = vm
+        self.interval = interval
+        self.exact = exact
+        if exact:
+            vm.stack = InstrumentedStack(vm.stack, vm.stack.limit)
+        self.executed = 0
+        self.opcode_counts = [0] * len(NAMES)
+        self.address_counts = [0] * 32768
+        self.targets = Counter()
+        self.stacks = Counter()
+        # as seen in the samples: deepest stack and recursion per function
+        self.peak = 0
+        self.recursion = {}
+        # instructions executed between consecutive input lines
+        self.input_gaps = []
+        # guest stack contents -> frame names, innermost last
+        self.frames = {}
+
+    def call_stack(self, stack) -> Tuple[str, ...]:
+        if self.exact:
+            return tuple(frame_name(target) for _, target in stack.frames)
+        key = stack.tobytes()
+        names = self.frames.get(key)
+        if names is None:
+            memory = self.vm.memory
+            # every return address follows the call that pushed it
+            names = tuple(frame_name(memory[w - 1], w - 2) for w in stack if 2 <= w < 32768 and memory[w - 2] == 17)
+            self.frames[key] = names
+            self.peak = max(self.peak, len(stack))
+            for name, depth in Counter(names).items():
+                if depth > self.recursion.get(name, 0):
+                    self.recursion[name] = depth
+        return names
+
+    def run(self, commands: List[str]):
+        # run the machine until it halts or wants more than <commands>,
+        # queueing them a line at a time as it asks for input
+        vm = self.vm
+        vm.interactive = False
+        lines = iter(commands)
+        memory = vm.memory
+        opcodes = self.opcode_counts
+        addresses = self.address_counts
+        targets = self.targets
+        stacks = self.stacks
+        call_stack = self.call_stack
+        interval = self.interval
+        executed = self.executed
+        last_input = executed
+        try:
+            while True:
+                pc = vm.counter
+                names = call_stack(vm.stack)
+                done = vm.step(interval)
+                if done:
+                    executed += done
+                    opcodes[memory[pc]] += done
+                    addresses[pc] += done
+                    targets[names[-1] if names else 'main'] += done
+                    stacks[names[-MAX_FRAMES:]] += done
+                if vm.running:
+                    continue
+                line = next(lines, None) if vm.waiting() else None
+                if line is None:
+                    break
+                self.input_gaps.append(executed - last_input)
+                last_input = executed
+                vm.add_commands([line])
+        finally:
+            self.executed = executed
+            vm.output.flush()
+
+
+def most_common(counts: List[int], top: int = None) -> List[Tuple[int, int]]:
+    # (index, count) of the nonzero entries, largest first
+    ranked = sorted(((i, c) for i, c in enumerate(counts) if c), key=lambda item: -item[1])
+    return ranked[:top]
+
+
+def flat_profile(profile: Profile, stream: TextIO, top: int = 20):
+    stack = profile.vm.stack
+    steps = sum(profile.opcode_counts)
+    total = steps or 1
+    stream.write(f'{profile.executed} instructions, {steps} sampled every {profile.interval}\n')
+    stream.write('\nopcode          count      %\n')
+    for op, count in most_common(profile.opcode_counts):
+        stream.write(f'{NAMES[op]:8} {count:12} {100 * count / total:6.2f}\n')
+    stream.write('\naddress         count      %\n')
+    for address, count in most_common(profile.address_counts, top):
+        stream.write(f'{address:8} {count:12} {100 * count / total:6.2f}\n')
+    if profile.exact:
+        calls = {frame_name(target): count for target, count in stack.calls.items()}
+        stream.write('\nfunction        self       %        calls\n')
+        for name, count in profile.targets.most_common(top):
+            stream.write(f'{name:8} {count:12} {100 * count / total:6.2f} {calls.get(name, 0):12}\n')
+        peak = stack.peak
+        recursion = {frame_name(target): depth for target, depth in stack.depths().items()}
+    else:
+        stream.write('\nfunction        self       %\n')
+        for name, count in profile.targets.most_common(top):
+            stream.write(f'{name:8} {count:12} {100 * count / total:6.2f}\n')
+        peak = profile.peak
+        recursion = dict(sorted(profile.recursion.items(), key=lambda item: -item[1]))
+    stream.write(f'\nstack peak {peak} words\nfunction   recursion\n')
+    for name, depth in list(recursion.items())[:top]:
+        stream.write(f'{name:8} {depth:11}\n')
+    stream.write('\ninstructions between input lines\n')
+    stream.write(' '.join(str(gap) for gap in profile.input_gaps) + '\n')
+
+
+def collapsed(profile: Profile, stream: TextIO):
+    # one "main;fn_a;fn_b count" line per stack, as flamegraph.pl expects
+    for frames, count in profile.stacks.most_common():
+        stream.write(f'{";".join(("main",) + frames)} {count}\n')
+
+
+def frame_name(target: int, site: int = None) -> str:
+    # calls through a register are named after the call instruction
+    return f'fn_{target}' if target < 32768 else f'via_{site}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile a run of a Synacor binary')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--commands', default='bot_commands.txt')
+    parser.add_argument('--engine', choices=ENGINES, default='compiled')
+    parser.add_argument('--interval', type=int, default=INTERVAL)
+    parser.add_argument('--exact', action='store_true', help='count calls, recursion and stack peak exactly')
+    parser.add_argument('--flat', default='profile.txt')
+    parser.add_argument('--collapsed', default='profile.folded')
+    args = parser.parse_args()
+    vm = ENGINES[args.engine]()
+    vm.import_file(Path(args.binary))
+    vm.output = NullOutput()
+    profile = Profile(vm, args.interval, args.exact)
+    profile.run(Path(args.commands).read_text().splitlines())
+    with Path(args.flat).open('w') as flat_file:
+        flat_profile(profile, flat_file)
+    with Path(args.collapsed).open('w') as collapsed_file:
+        collapsed(profile, collapsed_file)
@@ -0,0 +1,225 @@
+import argparse
+import re
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from analysis import length_prefixed
+from compiler import VirtualMachineCompiled
+from teleporter import patch, search
+from vmio import BufferOutput, NullOutput
+
+# from the start to the ruins' central hall, holding all five coins
+MONUMENT_ROUTE = [
+    'take tablet', 'go doorway', 'go north', 'go north', 'go bridge', 'go continue', 'go down', 'go east',
+    'take empty lantern', 'go west', 'go west', 'go passage', 'go ladder', 'go west', 'go south', 'go north',
+    'take can', 'use can', 'use lantern', 'go west', 'go ladder', 'go darkness', 'go continue', 'go west',
+    'go west', 'go west', 'go west', 'go north', 'take red coin', 'go north', 'go east', 'take concave coin',
+    'go down', 'take corroded coin', 'go up', 'go west', 'go west', 'take blue coin', 'go up',
+    'take shiny coin', 'go down', 'go east',
+]
+# from the opened monument to Synacor headquarters, before the teleporter
+# needs register 7
+HEADQUARTERS_ROUTE = ['go north', 'take teleporter', 'use teleporter', 'take business card', 'take strange book']
+# from headquarters to the vault antechamber, holding the orb
+VAULT_ROUTE = [
+    'use teleporter', 'go west', 'go north', 'go north', 'go north', 'go north', 'go north', 'go north',
+    'go north', 'go east', 'take journal', 'go west', 'go north', 'go north', 'take orb',
+]
+# what the monument prints when the coins are in the right order
+UNLOCKED = 'you hear a click'
+
+NUMBERS = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9}
+SHAPES = {'circle': 1, 'line': 2, 'triangle': 3, 'square': 4, 'pentagon': 5, 'hexagon': 6, 'heptagon': 7,
+          'octagon': 8, 'nonagon': 9}
+
+
+def strings(memory) -> List[Tuple[int, str]]:
+    # the length-prefixed strings of a running machine, after decryption
+    return length_prefixed(np.frombuffer(memory, dtype=np.uint16)[:32768])
+
+
+def read_string(memory, address: int) -> str:
+    return ''.join(map(chr, memory[address + 1:address + 1 + memory[address]]))
+
+
+def coin_values(table: List[Tuple[int, str]]) -> Dict[str, int]:
+    # every "... coin" item and the number on it; the description is the
+    # string stored right after the name
+    values = {}
+    for (_, name), (_, description) in zip(table, table[1:]):
+        if not name.endswith(' coin'):
+            continue
+        match = re.search(r'It has (?:(\w+) dots|an? (\w+)) on one side', description)
+        if match:
+            values[name] = NUMBERS.get(match[1]) or SHAPES.get(match[2])
+    return values
+
+
+def monument(table: List[Tuple[int, str]]) -> str:
+    for _, text in table:
+        match = re.search(r'^_.*=\s*\d+$', text, re.M)
+        if match:
+            return match[0]
+    raise ValueError('no monument equation found')
+
+
+def parse_equation(equation: str) -> Tuple[List[Tuple[int, List[int]]], int]:
+    # "_ + _ * _^2 - _ = n" as terms of (sign, exponent per slot) and n
+    left, right = equation.split('=')
+    terms = [(1, [])]
+    for token in left.split():
+        if token in '+-':
+            terms.append((1 if token == '+' else -1, []))
+        elif token.startswith('_'):
+            terms[-1][1].append(int(token[2:]) if '^' in token else 1)
+    return terms, int(right)
+
+
+def solve_coins(equation: str, values: Dict[str, int]) -> Optional[List[str]]:
+    # coin names in slot order. Slots are filled left to right; a partial
+    # assignment is dropped as soon as the unfilled terms, bounded by the
+    # smallest and largest coins left, can't bring the total to the target
+    terms, target = parse_equation(equation)
+    slots = [(t, e) for t, (_, exponents) in enumerate(terms) for e in exponents]
+
+    def bounds(slot: int, product: int, left: List[int]) -> Tuple[int, int]:
+        low = high = 0
+        lo, hi = min(left, default=0), max(left, default=0)
+        term_low = term_high = product
+        for i in range(slot, len(slots)):
+            t, e = slots[i]
+            term_low *= lo ** e
+            term_high *= hi ** e
+            if i + 1 == len(slots) or slots[i + 1][0] != t:
+                sign = terms[t][0]
+                low += min(sign * term_low, sign * term_high)
+                high += max(sign * term_low, sign * term_high)
+                term_low = term_high = 1
+        return low, high
+
+    def place(slot: int, total: int, product: int, left: Dict[str, int]) -> Optional[List[str]]:
+        if slot == len(slots):
+            return [] if total == target else None
+        t, e = slots[slot]
+        closes = slot + 1 == len(slots) or slots[slot + 1][0] != t
+        for name, value in left.items():
+            p = product * value ** e
+            new_total, new_product = (total + terms[t][0] * p, 1) if closes else (total, p)
+            rest = {n: v for n, v in left.items() if n != name}
+            low, high = bounds(slot + 1, new_product, list(rest.values()))
+            if not new_total + low <= target <= new_total + high:
+                continue
+            found = place(slot + 1, new_total, new_product, rest)
+            if found is not None:
+                return [name] + found
+        return None
+
+    return place(0, 0, 1, values)
+
+
+def room(memory, record: int) -> Tuple[str, str, Dict[str, int]]:
+    # a room record is name, description, exit names, exit rooms, callback;
+    # the exit lists are length-prefixed lists of addresses
+    name, description, names, targets = memory[record:record + 4]
+    exits = {read_string(memory, memory[names + 1 + i]): memory[targets + 1 + i] for i in range(memory[names])}
+    return read_string(memory, name), read_string(memory, description), exits
+
+
+def vault_grid(memory) -> Tuple[int, int, int, Dict[int, Tuple[str, Dict[str, int]]]]:
+    # (antechamber record, orb weight, door weight, record -> (tile, exits))
+    # for the rooms of the vault lock, read from the room records
+    words = np.frombuffer(memory, dtype=np.uint16)
+    pedestal = next(a for a, text in strings(memory) if "carved into the orb's pedestal" in text)
+    start = int(np.flatnonzero(words == pedestal)[0]) - 1
+    weight = int(re.search(r"number '(\d+)'", room(memory, start)[1])[1])
+    grid = {}
+    door = None
+    todo = [start]
+    while todo:
+        record = todo.pop()
+        if record in grid:
+            continue
+        _, description, exits = room(memory, record)
+        tile = re.search(r"mosaic depicting (?:the number '(\d+)'|a '(.)' symbol)", description)
+        if record != start and tile is None:
+            continue
+        locked = re.search(r"large '(\d+)' carved into it", description)
+        if locked:
+            door = int(locked[1])
+        grid[record] = (tile[1] or tile[2] if tile else str(weight), exits)
+        todo.extend(exits.values())
+    return start, weight, door, grid
+
+
+def solve_vault(memory) -> Optional[List[str]]:
+    # shortest list of exits taking the orb from the antechamber to the door
+    # with the door's weight; a breadth-first search over (room, weight,
+    # pending operator) that never revisits a state, never re-enters the
+    # antechamber, which resets the orb, and stops at the door
+    start, weight, target, grid = vault_grid(memory)
+    door = next(r for r, (_, exits) in grid.items() if 'vault' in exits)
+    operations = {'+': lambda a, b: a + b, '-': lambda a, b: a - b, '*': lambda a, b: a * b}
+    queue = deque([(start, weight, None, [])])
+    seen = {(start, weight, None)}
+    while queue:
+        record, value, operator, path = queue.popleft()
+        for direction, nxt in grid[record][1].items():
+            if nxt not in grid or nxt == start:
+                continue
+            tile = grid[nxt][0]
+            if tile in operations:
+                new_value, new_operator = value, tile
+            else:
+                new_value, new_operator = operations[operator](value, int(tile)), None
+            if not 0 < new_value < 32768:
+                continue
+            if nxt == door:
+                if new_value == target:
+                    return path + [direction]
+                continue
+            state = (nxt, new_value, new_operator)
+            if state not in seen:
+                seen.add(state)
+                queue.append((nxt, new_value, new_operator, path + [direction]))
+    return None
+
+
+def replay(vm, commands: List[str]) -> str:
+    vm.output = BufferOutput()
+    vm.add_commands(commands)
+    vm.run()
+    return vm.output.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solve the coin and vault puzzles and check the answers in the VM')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--r7', type=int, default=None, help='teleporter register value, searched for when missing')
+    args = parser.parse_args()
+    vm = VirtualMachineCompiled()
+    vm.import_file(Path(args.binary))
+    vm.interactive = False
+    vm.output = NullOutput()
+    replay(vm, MONUMENT_ROUTE)
+
+    start = time.perf_counter()
+    table = strings(vm.memory)
+    coins = solve_coins(monument(table), coin_values(table))
+    solved = time.perf_counter() - start
+    text = replay(vm, [f'use {coin}' for coin in coins])
+    print(f'coins: {", ".join(coins)} in {1000 * solved:.1f}ms, {"verified" if UNLOCKED in text else "REJECTED"}')
+
+    replay(vm, HEADQUARTERS_ROUTE)
+    patch(vm, args.r7 if args.r7 is not None else search()[0])
+    replay(vm, VAULT_ROUTE)
+    start = time.perf_counter()
+    path = solve_vault(vm.memory)
+    solved = time.perf_counter() - start
+    door = next(r for r, (_, exits) in vault_grid(vm.memory)[3].items() if 'vault' in exits)
+    vault = room(vm.memory, room(vm.memory, door)[2]['vault'])[0]
+    text = replay(vm, [f'go {d}' for d in path] + ['go vault'])
+    print(f'vault: {" ".join(path)} in {1000 * solved:.1f}ms, {"verified" if f"== {vault} ==" in text else "REJECTED"}')
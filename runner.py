@@ -0,0 +1,77 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+from compiler import VirtualMachineCompiled
+from explorer import CODE, play
+from vmio import NullOutput
+
+# per-process machine and its post-self-test state, set up by init_worker
+vm = None
+base = b''
+
+
+class Result(NamedTuple):
+    script: str
+    # game output from the first prompt on
+    transcript: str
+    codes: List[str]
+    state_hash: str
+    halted: bool
+
+
+def warm_snapshot(binary: str) -> bytes:
+    # the state at the first prompt, after the self-test and decryption
+    machine = VirtualMachineCompiled()
+    machine.import_file(Path(binary))
+    machine.interactive = False
+    machine.output = NullOutput()
+    machine.run()
+    return machine.snapshot()
+
+
+def init_worker(binary: str, warm: bytes):
+    global vm, base
+    vm = VirtualMachineCompiled()
+    vm.import_file(Path(binary))
+    vm.interactive = False
+    vm.restore(warm)
+    # per-script restores then only touch the pages the script dirtied
+    vm.rebase()
+    base = vm.snapshot()
+
+
+def run_script(name: str, commands: List[str]) -> Result:
+    text = play(vm, base, commands)
+    halted = vm.memory[vm.counter] != 20
+    digest = hashlib.blake2b(vm.snapshot(), digest_size=16).hexdigest()
+    return Result(name, text, sorted(set(CODE.findall(text))), digest, halted)
+
+
+def run_scripts(binary: str, scripts: Dict[str, List[str]], workers: int = None) -> List[Result]:
+    # every script from the same warm state, in the order given
+    warm = warm_snapshot(binary)
+    workers = min(workers or os.cpu_count(), len(scripts)) or 1
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(binary, warm)) as pool:
+        return list(pool.map(run_script, scripts.keys(), scripts.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run command scripts against a Synacor binary headlessly')
+    parser.add_argument('scripts', nargs='+', help='files with one command per line')
+    parser.add_argument('--binary', default='challenge.bin')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--json', help='write one JSON result per line here')
+    args = parser.parse_args()
+    results = run_scripts(args.binary, {s: Path(s).read_text().splitlines() for s in args.scripts}, args.workers)
+    if args.json:
+        with Path(args.json).open('w') as json_file:
+            for result in results:
+                json_file.write(json.dumps(result._asdict()) + '\n')
+    for result in results:
+        status = 'halted' if result.halted else 'waiting'
+        print(f'{result.script}: {status} {result.state_hash} {" ".join(result.codes)}')
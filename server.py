@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import itertools
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from engine import Machine
+from vmio import BufferOutput
+
+# instructions a session runs before giving the other sessions a turn
+BUDGET = 20000
+# seconds without a command before a session is snapshotted and dropped
+IDLE = 300.0
+
+
+class Session:
+    def __init__(self, number: int, vm: Machine):
+        self.number = number
+        self.vm: Optional[Machine] = vm
+        # the machine's snapshot while it is evicted
+        self.blob = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.instructions = 0
+        self.halted = False
+        self.closed = False
+
+
+class Server:
+    # independent machines behind one event loop. Each command runs its
+    # session to the next prompt in slices of <budget> instructions, yielding
+    # between slices so a spinning guest only slows its own session; sessions
+    # idle for <idle> seconds are kept as snapshots until their next command
+    def __init__(self, binary: Path, budget: int = BUDGET, idle: float = IDLE):
+        self.binary = binary
+        self.budget = budget
+        self.idle = idle
+        self.sessions: Dict[int, Session] = {}
+        self.numbers = itertools.count(1)
+
+    def machine(self) -> Machine:
+        vm = Machine()
+        vm.import_file(self.binary)
+        vm.interactive = False
+        vm.output = BufferOutput()
+        return vm
+
+    def wake(self, session: Session) -> Machine:
+        if session.vm is None:
+            vm = self.machine()
+            vm.restore(session.blob)
+            session.vm, session.blob = vm, None
+        session.last_used = time.monotonic()
+        return session.vm
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for session in self.sessions.values():
+            if session.vm is not None and not session.lock.locked() and now - session.last_used > self.idle:
+                session.blob = session.vm.snapshot()
+                session.vm = None
+
+    async def reaper(self):
+        while True:
+            await asyncio.sleep(self.idle / 4)
+            self.evict_idle()
+
+    async def execute(self, session: Session, command: Optional[str]) -> str:
+        # feed <command> and run to the next prompt; returns the output
+        async with session.lock:
+            if session.halted:
+                raise ValueError(f'session {session.number} has halted')
+            vm = self.wake(session)
+            if command is not None:
+                vm.add_commands([command])
+            while not session.closed:
+                session.instructions += vm.step(self.budget)
+                if not vm.running:
+                    break
+                await asyncio.sleep(0)
+            vm.output.flush()
+            session.halted = vm.memory[vm.counter] != 20
+            session.last_used = time.monotonic()
+            text = vm.output.getvalue()
+            vm.output.clear()
+            return text
+
+    def create(self) -> Session:
+        session = Session(next(self.numbers), self.machine())
+        self.sessions[session.number] = session
+        return session
+
+    def close(self, number: int):
+        session = self.sessions.pop(number)
+        session.closed = True
+
+    def session(self, word: str) -> Session:
+        session = self.sessions.get(int(word))
+        if session is None:
+            raise ValueError(f'no session {word}')
+        return session
+
+    def status(self) -> str:
+        return '\n'.join(f'{s.number} {"halted" if s.halted else "live" if s.vm else "evicted"} {s.instructions}'
+                         for s in self.sessions.values())
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # one request per line: "new", "send ID TEXT", "close ID", "list" or
+        # "quit"; every reply is "ok ID LENGTH" or "error LENGTH" followed by
+        # LENGTH bytes of UTF-8 text
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode().rstrip('\r\n').split(' ', 2)
+                number, text = 0, ''
+                try:
+                    if words[0] == 'new':
+                        session = self.create()
+                        number, text = session.number, await self.execute(session, None)
+                    elif words[0] == 'send':
+                        session = self.session(words[1])
+                        number, text = session.number, await self.execute(session, words[2] if len(words) > 2 else '')
+                    elif words[0] == 'close':
+                        number = self.session(words[1]).number
+                        self.close(number)
+                    elif words[0] == 'list':
+                        text = self.status()
+                    elif words[0] == 'quit':
+                        break
+                    else:
+                        raise ValueError(f'unknown request {words[0]!r}')
+                except (IndexError, ValueError) as error:
+                    data = str(error).encode()
+                    writer.write(f'error {len(data)}\n'.encode() + data)
+                else:
+                    data = text.encode()
+                    writer.write(f'ok {number} {len(data)}\n'.encode() + data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(server: Server, host: str, port: int, unix: Optional[str]):
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle, unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    reaper = asyncio.create_task(server.reaper())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        reaper.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Host many Synacor sessions behind a socket')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9017)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead')
+    parser.add_argument('--budget', type=int, default=BUDGET, help='instructions per scheduling slice')
+    parser.add_argument('--idle', type=float, default=IDLE, help='seconds before an idle session is evicted')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(Server(Path(args.binary), args.budget, args.idle), args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
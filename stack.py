@@ -0,0 +1,99 @@
+from array import array
+from typing import Dict, Optional
+
+# default bound on the guest stack, in words
+LIMIT = 1 << 20
+
+
+class StackOverflow(RuntimeError):
+    pass
+
+
+class StackUnderflow(IndexError):
+    pass
+
+
+class Stack(array):
+    # the guest stack as an array of 16-bit words. push and pop stay the C
+    # array methods; call() adds the <limit> check and ret() the halt on an
+    # empty stack, so deep recursion is caught at the instruction that
+    # causes it. Every engine runs these, so they do nothing else; see
+    # InstrumentedStack for depth and frame tracking
+    def __new__(cls, words=b'', limit: int = LIMIT):
+        stack = super().__new__(cls, 'H', words)
+        stack.limit = limit
+        return stack
+
+    def call(self, return_address: int, target: int):
+        if len(self) >= self.limit:
+            raise StackOverflow(f'stack limit of {self.limit} words reached calling {target}')
+        self.append(return_address)
+
+    def ret(self) -> Optional[int]:
+        # the return address, or None when the stack is empty, which the
+        # spec says halts the machine
+        return self.pop() if self else None
+
+    def reset(self, words):
+        self[:] = array('H', words)
+
+
+class InstrumentedStack(Stack):
+    # a Stack that also keeps the <peak> depth, the open call frames, and per
+    # call target the calls made and the most simultaneous frames. It costs
+    # every call and ret a few dict and list updates, so only the profiler
+    # installs it. Frames the guest pops by hand are closed on the next call
+    # or ret
+    def __new__(cls, words=b'', limit: int = LIMIT):
+        stack = super().__new__(cls, words, limit)
+        stack.peak = len(stack)
+        # (depth with the return address pushed, call target) per open frame
+        stack.frames = []
+        # call target -> calls made, frames open now, and the most ever open
+        # at once
+        stack.calls = {}
+        stack.active = {}
+        stack.recursion = {}
+        return stack
+
+    def call(self, return_address: int, target: int):
+        depth = len(self) + 1
+        if depth > self.limit:
+            raise StackOverflow(f'stack limit of {self.limit} words reached calling {target}')
+        frames = self.frames
+        if frames and frames[-1][0] >= depth:
+            self.unwind(depth - 1)
+        self.append(return_address)
+        if depth > self.peak:
+            self.peak = depth
+        frames.append((depth, target))
+        self.calls[target] = self.calls.get(target, 0) + 1
+        active = self.active.get(target, 0) + 1
+        self.active[target] = active
+        if active > self.recursion.get(target, 0):
+            self.recursion[target] = active
+
+    def ret(self) -> Optional[int]:
+        if not self:
+            return None
+        address = self.pop()
+        frames = self.frames
+        if frames and frames[-1][0] > len(self):
+            self.unwind(len(self))
+        return address
+
+    def unwind(self, depth: int):
+        # close the frames whose return address is no longer on the stack,
+        # including ones the guest popped itself
+        frames = self.frames
+        while frames and frames[-1][0] > depth:
+            self.active[frames.pop()[1]] -= 1
+
+    def reset(self, words):
+        self[:] = array('H', words)
+        self.frames.clear()
+        self.active.clear()
+
+    def depths(self) -> Dict[int, int]:
+        # call target -> deepest recursion seen, deepest first
+        return dict(sorted(self.recursion.items(), key=lambda item: -item[1]))
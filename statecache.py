@@ -0,0 +1,123 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from compiler import VirtualMachineCompiled
+from vm import VirtualMachine
+from vmio import NullOutput, TerminalOutput
+
+
+class StateCache:
+    # machine snapshots at input prompts, one file per (binary, input prefix).
+    # File modification times double as the LRU order: loads touch them,
+    # stores evict the oldest files until the directory is under <limit> bytes.
+    def __init__(self, directory: Path = Path('.statecache'), limit: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.limit = limit
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, binary_digest: str, prefix_digest: str) -> Path:
+        return self.directory / f'{binary_digest[:16]}-{prefix_digest}.state'
+
+    def load(self, machine: Callable[[], VirtualMachine], path: Path) -> Optional[VirtualMachine]:
+        # a machine from <machine>, freshly loaded, with the snapshot at <path>
+        # restored; None when there is no such file or it is truncated or
+        # damaged, so a failed restore never touches a machine in use
+        try:
+            with path.open('rb') as state_file:
+                blob = mmap.mmap(state_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        vm = machine()
+        try:
+            vm.restore(blob)
+        except (ValueError, struct.error):
+            return None
+        os.utime(path)
+        return vm
+
+    def store(self, vm: VirtualMachine, path: Path):
+        partial = path.with_suffix('.tmp')
+        partial.write_bytes(vm.snapshot())
+        os.replace(partial, path)
+        self.evict()
+
+    def evict(self):
+        files = sorted(self.directory.glob('*.state'), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        while files and total > self.limit:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink()
+
+
+def prefix_digests(commands: List[str]) -> List[str]:
+    # digest of commands[:i] for every i, empty prefix first
+    h = hashlib.sha256()
+    digests = [h.hexdigest()]
+    for command in commands:
+        h.update(command.encode() + b'\n')
+        digests.append(h.hexdigest())
+    return digests
+
+
+def resume(machine: Callable[[], VirtualMachine], binary: Path, commands: List[str],
+           cache: StateCache) -> Tuple[VirtualMachine, int]:
+    # a machine from <machine> with <binary> loaded and brought to the prompt
+    # after <commands>, restoring the longest cached prefix and caching every
+    # prompt replayed after it; returns it and how many commands came from
+    # the cache
+    data = binary.read_bytes()
+    binary_digest = hashlib.sha256(data).hexdigest()
+
+    def fresh() -> VirtualMachine:
+        vm = machine()
+        vm.import_file(binary)
+        vm.interactive = False
+        return vm
+
+    digests = prefix_digests(commands)
+    for cached in range(len(commands), -1, -1):
+        vm = cache.load(fresh, cache.path(binary_digest, digests[cached]))
+        if vm is not None:
+            break
+    else:
+        cached = 0
+        vm = fresh()
+        vm.run()
+        cache.store(vm, cache.path(binary_digest, digests[0]))
+    for i in range(cached, len(commands)):
+        vm.add_commands([commands[i]])
+        vm.run()
+        cache.store(vm, cache.path(binary_digest, digests[i + 1]))
+    return vm, cached
+
+
+def quiet_machine() -> VirtualMachine:
+    vm = VirtualMachineCompiled()
+    vm.output = NullOutput()
+    return vm
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play a Synacor binary from a cached command prefix')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--commands', default='bot_commands.txt')
+    parser.add_argument('--upto', type=int, default=None, help='how many commands of the file to replay')
+    parser.add_argument('--cache', default='.statecache')
+    parser.add_argument('--limit', type=int, default=64, help='cache size cap in MiB')
+    args = parser.parse_args()
+    prefix = Path(args.commands).read_text().splitlines()[:args.upto]
+    start = time.perf_counter()
+    cache = StateCache(Path(args.cache), args.limit * 1024 * 1024)
+    vm, hits = resume(quiet_machine, Path(args.binary), prefix, cache)
+    print(f'{hits} of {len(prefix)} commands from the cache, ready in {time.perf_counter() - start:.3f}s')
+    vm.output = TerminalOutput()
+    vm.interactive = True
+    vm.add_commands(['look'])
+    vm.run()
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import pytest
+
+import journal
+from engine import ENGINES
+from journal import Journal
+from vmio import BufferOutput
+
+ROOT = Path(__file__).parent.parent
+COMMANDS = (ROOT / 'bot_commands.txt').read_text().splitlines()
+
+
+def machine(name: str):
+    vm = ENGINES[name]()
+    vm.import_file(ROOT / 'challenge.bin')
+    vm.interactive = False
+    vm.output = BufferOutput()
+    return vm
+
+
+def finished(name: str) -> bytes:
+    vm = machine(name)
+    vm.add_commands(COMMANDS)
+    vm.run()
+    return vm.snapshot()
+
+
+@pytest.mark.parametrize('name', ENGINES)
+@pytest.mark.parametrize('every, checkpointed', [(1, 6), (4, 4), (100, 0)])
+def test_replay_after_crash(name, every, checkpointed, tmp_path):
+    # a run journaled until it stops seven lines into the walkthrough, then
+    # resumed from its newest checkpoint, or from the start with none. The
+    # seventh line is checkpointed only when the eighth is about to be read
+    vm = machine(name)
+    log = Journal(tmp_path, every=every)
+    log.resume(vm)
+    vm.add_commands(COMMANDS)
+    vm.step(720000)
+    log.close()
+    assert log.consumed == 7
+    log = Journal(tmp_path, every=every)
+    assert log.lines == COMMANDS
+    resumed = machine(name)
+    replayed = log.resume(resumed)
+    assert log.checkpointed == checkpointed
+    assert replayed == len(COMMANDS) - log.checkpointed
+    resumed.run()
+    log.close()
+    assert resumed.snapshot() == finished(name)
+
+
+def test_torn_line_is_dropped(tmp_path):
+    (tmp_path / 'inputs.log').write_text('north\nsou')
+    log = Journal(tmp_path)
+    assert log.lines == ['north']
+    log.close()
+    assert (tmp_path / 'inputs.log').read_text() == 'north\n'
+
+
+def test_old_checkpoints_are_deleted(tmp_path):
+    vm = machine('compiled')
+    log = Journal(tmp_path, every=1)
+    log.resume(vm)
+    vm.add_commands(COMMANDS)
+    vm.run()
+    log.close()
+    assert len(log.checkpoints()) == journal.KEEP
@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import pytest
+
+from engine import ENGINES
+from vmio import BufferOutput
+
+ROOT = Path(__file__).parent.parent
+COMMANDS = (ROOT / 'bot_commands.txt').read_text().splitlines()
+
+
+def machine(name: str):
+    vm = ENGINES[name]()
+    vm.import_file(ROOT / 'challenge.bin')
+    vm.interactive = False
+    vm.output = BufferOutput()
+    return vm
+
+
+@pytest.mark.parametrize('name', ENGINES)
+def test_round_trip(name):
+    vm = machine(name)
+    vm.add_commands(COMMANDS)
+    assert vm.step(300000) == 300000
+    blob = vm.snapshot()
+    # onto a fresh machine
+    copy = machine(name)
+    copy.restore(blob)
+    assert copy.snapshot() == blob
+    # and back onto the machine after it has run on
+    vm.step(200000)
+    after = vm.snapshot()
+    vm.restore(blob)
+    assert vm.snapshot() == blob
+    vm.output.clear()
+    vm.step(200000)
+    copy.step(200000)
+    assert vm.snapshot() == copy.snapshot() == after
+    assert vm.output.getvalue() == copy.output.getvalue()
+
+
+@pytest.mark.parametrize('name', ENGINES)
+def test_runs_to_the_same_end(name):
+    vm = machine(name)
+    vm.add_commands(COMMANDS)
+    vm.step(300000)
+    copy = machine(name)
+    copy.restore(vm.snapshot())
+    vm.run()
+    copy.run()
+    assert copy.snapshot() == vm.snapshot()
+    assert not copy.running and copy.waiting()
+
+
+def test_other_image_is_refused():
+    vm = machine('interpreter')
+    vm.step(1000)
+    blob = vm.snapshot()
+    other = machine('interpreter')
+    other.memory[30000] ^= 1
+    other.rebase()
+    with pytest.raises(ValueError, match='restored onto image'):
+        other.restore(blob)
+    assert other.counter == 0
+
+
+def test_truncated_is_refused():
+    vm = machine('interpreter')
+    blob = vm.snapshot()
+    with pytest.raises(ValueError):
+        vm.restore(blob[:-1])
@@ -0,0 +1,143 @@
+import argparse
+import struct
+import zlib
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from vm import VirtualMachine
+from vmio import NullOutput
+
+MAGIC = b'SYNTRACE1\n'
+# first instruction index, instruction count, compressed snapshot and
+# compressed record sizes
+CHUNK_HEADER = struct.Struct('<QIII')
+# pc, opcode, up to three operand values as read before execution, then the
+# written destination (0xffff for none; 32768.. for registers) and value
+RECORD = struct.Struct('<HB3HHH')
+NO_WRITE = 0xffff
+
+
+class TraceWriter:
+    def __init__(self, path: Path, chunk: int = 65536, level: int = 6):
+        self.file = path.open('wb')
+        self.file.write(MAGIC)
+        self.chunk = chunk
+        self.level = level
+        self.first = 0
+        self.count = 0
+        self.snapshot = b''
+        self.records = bytearray(chunk * RECORD.size)
+
+    def start(self, first: int, snapshot: bytes):
+        self.first = first
+        self.snapshot = snapshot
+
+    def add(self, pc: int, op: int, a: int, b: int, c: int, destination: int, value: int):
+        RECORD.pack_into(self.records, self.count * RECORD.size, pc, op, a, b, c, destination, value)
+        self.count += 1
+        if self.count == self.chunk:
+            self.flush()
+
+    def flush(self):
+        if not self.count:
+            return
+        snapshot = zlib.compress(self.snapshot, self.level)
+        records = zlib.compress(memoryview(self.records)[:self.count * RECORD.size], self.level)
+        self.file.write(CHUNK_HEADER.pack(self.first, self.count, len(snapshot), len(records)))
+        self.file.write(snapshot)
+        self.file.write(records)
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TraceReader:
+    def __init__(self, path: Path, binary: Path):
+        self.path = path
+        self.binary = binary
+        # (first, count, offset of the snapshot, snapshot size, records size)
+        self.chunks = []
+        with path.open('rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a trace file')
+            while True:
+                header = file.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    break
+                first, count, snapshot_size, records_size = CHUNK_HEADER.unpack(header)
+                self.chunks.append((first, count, file.tell(), snapshot_size, records_size))
+                file.seek(snapshot_size + records_size, 1)
+
+    def __len__(self):
+        if not self.chunks:
+            return 0
+        first, count = self.chunks[-1][:2]
+        return first + count
+
+    def load(self, chunk) -> Tuple[bytes, bytes]:
+        first, count, offset, snapshot_size, records_size = chunk
+        with self.path.open('rb') as file:
+            file.seek(offset)
+            snapshot = zlib.decompress(file.read(snapshot_size))
+            records = zlib.decompress(file.read(records_size))
+        return snapshot, records
+
+    def find(self, n: int):
+        for chunk in self.chunks:
+            if chunk[0] <= n < chunk[0] + chunk[1]:
+                return chunk
+        raise IndexError(f'instruction {n} is not in the trace')
+
+    def records(self, start: int = 0, stop: int = None) -> Iterator[tuple]:
+        # decoded (index, pc, opcode, a, b, c, destination, value) records,
+        # one chunk in memory at a time
+        stop = len(self) if stop is None else stop
+        for chunk in self.chunks:
+            first, count = chunk[:2]
+            if first + count <= start or first >= stop:
+                continue
+            records = self.load(chunk)[1]
+            for i in range(max(start, first), min(stop, first + count)):
+                yield (i,) + RECORD.unpack_from(records, (i - first) * RECORD.size)
+
+    def state_at(self, n: int) -> VirtualMachine:
+        # a machine about to execute instruction <n>, rebuilt from the
+        # nearest chunk snapshot by replaying the recorded input
+        if n == len(self):
+            chunk = self.chunks[-1]
+        else:
+            chunk = self.find(n)
+        from engine import Machine
+        snapshot, records = self.load(chunk)
+        vm = Machine()
+        vm.import_file(self.binary)
+        vm.restore(snapshot)
+        vm.input_buffer.clear()
+        vm.interactive = False
+        vm.output = NullOutput()
+        for i in range(n - chunk[0]):
+            pc, op, a, b, c, destination, value = RECORD.unpack_from(records, i * RECORD.size)
+            if vm.counter != pc:
+                raise ValueError(f'replay diverged at instruction {chunk[0] + i}: {vm.counter} != {pc}')
+            if op == 20:
+                vm.input_buffer.append(chr(value))
+            vm.step()
+        vm.running = False
+        return vm
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record an execution trace of a Synacor binary')
+    parser.add_argument('binary', nargs='?', default='challenge.bin')
+    parser.add_argument('--commands', default='bot_commands.txt')
+    parser.add_argument('--output', default='challenge.trace')
+    args = parser.parse_args()
+    from engine import Machine
+    writer = TraceWriter(Path(args.output))
+    vm = Machine('traced', writer)
+    vm.import_file(Path(args.binary))
+    vm.add_commands(Path(args.commands).read_text().splitlines())
+    vm.run()
+    writer.close()
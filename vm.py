@@ -1,452 +1,451 @@
+import hashlib
 import struct
+import sys
+from array import array
+from collections import deque
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+
+from operations import ARITY, CHECKED_STEPS, DECODED_STEPS, PAGE_BITS, PURE
+from stack import Stack, StackUnderflow
+from vmio import TerminalInput, TerminalOutput
+
+# snapshots store memory in pages of this many words
+PAGE = 1 << PAGE_BITS
+PAGES = 32768 // PAGE
+# dirty pages up to which snapshots compare them one slice at a time; more
+# are compared in one numpy operation
+SLICED_PAGES = 16
+# counter, stack length, input buffer length in bytes, number of pages and
+# the digest of the image the pages were diffed against
+SNAPSHOT_HEADER = struct.Struct('<HIII8s')
+# executions of a cached instruction before a superinstruction is tried there
+HOT = 16
+# longest straight-line run folded into one superinstruction
+MAX_FUSED = 16
+# register arithmetic a superinstruction may contain, as opcode -> f(b, c)
+FUSABLE = dict(PURE)
+
+
+def le_bytes(words: array) -> bytes:
+    if sys.byteorder == 'big':
+        words = array('H', words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def image_digest(image: array) -> bytes:
+    return hashlib.blake2b(le_bytes(image), digest_size=8).digest()
+
+
+# the digest of an all-zero image, which a new machine starts with
+EMPTY_DIGEST = image_digest(array('H', bytes(2 * 32768)))
+
+
+def le_words(data) -> array:
+    words = array('H', data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
 
 
 class VirtualMachine:
     def __init__(self):
-        self.registers = [0, 0, 0, 0, 0, 0, 0, 0]
+        # the 15-bit address space followed by the eight registers, so a raw
+        # operand 32768..32775 indexes its register directly
+        self.memory = array('H', bytes(2 * 32776))
+        self.registers = memoryview(self.memory)[32768:]
+        # the address space as loaded, which snapshots are diffed against
+        self.image = array('H', bytes(2 * 32768))
+        self.image_digest = EMPTY_DIGEST
+        # per page, 1 when it may differ from the image; every memory write
+        # marks its page, so snapshots only compare those. One more entry
+        # absorbs register writes marked by unchecked stores
+        self.dirty = bytearray(PAGES + 1)
+        self.size = 0
         self.counter = 0
-        self.stack = []
-        self.memory = []
-        self.input_buffer = []
+        self.stack = Stack()
+        self.input_buffer = deque()
+        self.input_source = TerminalInput()
+        self.output = TerminalOutput()
         self.running = False
-        self.command_log = Path('command.log').open('w')
-        self.operations = {
-            0: self.halt,
-            1: self.set_opr,
-            2: self.push,
-            3: self.pop,
-            4: self.eq,
-            5: self.gt,
-            6: self.jmp,
-            7: self.jt,
-            8: self.jf,
-            9: self.add,
-            10: self.mult,
-            11: self.mod,
-            12: self.and_opr,
-            13: self.or_opr,
-            14: self.not_opr,
-            15: self.rmem,
-            16: self.wmem,
-            17: self.call,
-            18: self.ret,
-            19: self.out,
-            20: self.in_opr,
-            21: self.noop,
-        }
+        # when False, running out of input stops the machine at the `in`
+        # instruction instead of prompting, so it can be resumed with run()
+        self.interactive = True
+        # call target -> native routine run in place of the guest code
+        self.accelerated = {}
+        # a journal.Journal recording every input line, or None
+        self.journal = None
 
     def run(self):
         self.running = True
-        while self.running:
-            self.operations[self.memory[self.counter]]()
+        m = self.memory
+        st = self.stack
+        steps = CHECKED_STEPS
+        pc = self.counter
+        try:
+            while self.running:
+                pc = steps[m[pc]](self, m, pc, st)
+        finally:
+            self.counter = pc
+        self.output.flush()
+
+    def step(self, limit: int = 1) -> int:
+        # run <limit> instructions, or fewer when the machine stops first, and
+        # return how many ran; vm.running is still True afterwards when the
+        # limit ran out. Engines that dispatch several instructions at once
+        # step the last few singly, so every engine stops at the same place
+        self.running = True
+        m = self.memory
+        st = self.stack
+        steps = CHECKED_STEPS
+        pc = self.counter
+        done = 0
+        try:
+            while self.running and done < limit:
+                pc = steps[m[pc]](self, m, pc, st)
+                done += 1
+        finally:
+            self.counter = pc
+        return done - 1 if self.waiting() else done
+
+    def waiting(self) -> bool:
+        # stopped at an in for want of input; the in runs again on resume, so
+        # step() doesn't count it
+        return not self.running and self.memory[self.counter] == 20
 
     def dump_strings(self):
         out = []
-        for x in range(len(self.memory)):
+        for x in range(32767):
             if self.memory[x] == 19:
                 out.append(chr(self.memory[x+1]))
         return ''.join(out)
 
     def import_file(self, file: Path):
-        st = struct.Struct('<H')
-        self.memory = [i[0] for i in st.iter_unpack(file.open('rb').read())]
+        # validated and mapped by the loader; one copy into memory, swapped to
+        # native order by numpy. The loader and numpy are imported here and in
+        # the snapshot methods, so a machine that only runs doesn't load numpy
+        import numpy as np
+        from loader import load_image
+        image = load_image(file)
+        self.size = len(image)
+        np.frombuffer(self.memory, dtype=np.uint16)[:self.size] = image
+        self.rebase()
+
+    def rebase(self):
+        # diff later snapshots against the current memory instead of the
+        # loaded file; restore() refuses snapshots taken against the old image
+        self.image = self.memory[:32768]
+        self.image_digest = image_digest(self.image)
+        self.dirty[:] = bytes(PAGES + 1)
+
+    def memory_written(self, start: int = 0, end: int = 32768):
+        # for code writing memory[start:end] directly instead of through the
+        # machine, so the next snapshot compares those pages
+        for i in range(start // PAGE, (end - 1) // PAGE + 1):
+            self.dirty[i] = 1
+
+    def page_arrays(self):
+        # memory and image as PAGES x PAGE word arrays over the same buffers
+        import numpy as np
+        memory = np.frombuffer(self.memory, dtype=np.uint16)[:32768].reshape(PAGES, PAGE)
+        image = np.frombuffer(self.image, dtype=np.uint16).reshape(PAGES, PAGE)
+        return memory, image
+
+    def dirty_pages(self) -> List[int]:
+        # start addresses of the pages that differ from the loaded image,
+        # comparing only the pages written since; a page written back to
+        # its loaded contents is clean again
+        dirty = self.dirty
+        if dirty.count(1, 0, PAGES) <= SLICED_PAGES:
+            memory = self.memory
+            image = self.image
+            pages = []
+            i = dirty.find(1, 0, PAGES)
+            while i >= 0:
+                p = i * PAGE
+                if memory[p:p + PAGE] != image[p:p + PAGE]:
+                    pages.append(p)
+                else:
+                    dirty[i] = 0
+                i = dirty.find(1, i + 1, PAGES)
+            return pages
+        import numpy as np
+        marked = np.flatnonzero(np.frombuffer(dirty, dtype=np.uint8)[:PAGES])
+        memory, image = self.page_arrays()
+        differ = (memory[marked] != image[marked]).any(axis=1)
+        for i in marked[~differ].tolist():
+            dirty[i] = 0
+        return (marked[differ] * PAGE).tolist()
+
+    def snapshot(self) -> bytes:
+        import numpy as np
+        pages = self.dirty_pages()
+        text = ''.join(self.input_buffer).encode()
+        # each page as its start address followed by its words
+        records = np.empty((len(pages), 1 + PAGE), dtype='<u2')
+        records[:, 0] = pages
+        records[:, 1:] = self.page_arrays()[0][np.array(pages, dtype=int) // PAGE]
+        blob = [
+            SNAPSHOT_HEADER.pack(self.counter, len(self.stack), len(text), len(pages), self.image_digest),
+            le_bytes(self.memory[32768:]),
+            le_bytes(self.stack),
+            text,
+            records.tobytes(),
+        ]
+        return b''.join(blob)
+
+    def restore(self, blob: bytes):
+        # raises ValueError, before changing the machine, for a blob that is
+        # not a whole snapshot or was taken against another image
+        import numpy as np
+        if len(blob) < SNAPSHOT_HEADER.size:
+            raise ValueError(f'a snapshot of {len(blob)} bytes has no room for its header')
+        counter, stack_size, text_size, page_count, digest = SNAPSHOT_HEADER.unpack_from(blob)
+        size = SNAPSHOT_HEADER.size + 16 + 2 * stack_size + text_size + page_count * 2 * (1 + PAGE)
+        if len(blob) != size or page_count > PAGES:
+            raise ValueError(f'a snapshot of {len(blob)} bytes whose header describes {size} bytes')
+        if digest != self.image_digest:
+            raise ValueError(f'a snapshot of image {digest.hex()} restored onto image {self.image_digest.hex()}')
+        offset = SNAPSHOT_HEADER.size
+        registers = le_words(blob[offset:offset + 16])
+        offset += 16
+        stack = le_words(blob[offset:offset + 2 * stack_size])
+        offset += 2 * stack_size
+        text = blob[offset:offset + text_size].decode()
+        offset += text_size
+        records = np.frombuffer(blob, dtype='<u2', count=page_count * (1 + PAGE), offset=offset)
+        records = records.reshape(page_count, 1 + PAGE)
+        if (records[:, 0] % PAGE).any() or (records[:, 0] >= 32768).any():
+            raise ValueError('a snapshot page starts off a page boundary')
+        self.memory[32768:] = registers
+        self.stack.reset(stack)
+        self.input_buffer = deque(text)
+        indices = records[:, 0] // PAGE
+        memory, image = self.page_arrays()
+        # only pages dirty now or in the snapshot need to be written, and only
+        # the ones that change are reported
+        stale = np.setdiff1d(np.array(self.dirty_pages(), dtype=int) // PAGE, indices)
+        differ = (memory[indices] != records[:, 1:]).any(axis=1)
+        changed = indices[differ]
+        memory[stale] = image[stale]
+        memory[changed] = records[differ, 1:]
+        for i in np.concatenate([stale, changed]).tolist():
+            self.memory_reloaded(i * PAGE, (i + 1) * PAGE)
+        dirty = np.frombuffer(self.dirty, dtype=np.uint8)
+        dirty[:PAGES] = 0
+        dirty[indices] = 1
+        self.counter = counter
+
+    def accelerate(self, address: int, routine):
+        # run routine(vm) instead of the guest code whenever <address> is
+        # called; it must leave registers and memory as the guest code would
+        self.accelerated[address] = routine
+
+    def memory_reloaded(self, start: int, end: int):
+        # called when restore() overwrites memory[start:end] directly
+        pass
 
     def add_commands(self, commands: List):
         for command in commands:
-            self.input_buffer.extend(list(command))
+            if self.journal is not None:
+                self.journal.record(command)
+            self.input_buffer.extend(command)
             self.input_buffer.append('\n')
 
-    def get_value(self, n: int) -> int:
-        if n > 32767:
-            return self.registers[n - 32768]
-        return n
-
-    def set_value(self, n, v):
-        if n > 32767:
-            self.registers[n - 32768] = v
-        else:
-            self.memory[n] = v
-
-    def halt(self):
-        # halt: 0
-        #   stop execution and terminate the program
-        self.running = False
-
-    def set_opr(self):
-        # set: 1 a b
-        #   set register <a> to the value of <b>
-        a, b = self.memory[self.counter+1: self.counter+3]
-        b = self.get_value(b)
-        self.set_value(a, b)
-        self.counter += 3
-
-    def push(self):
-        # push: 2 a
-        #   push <a> onto the stack
-        a = self.get_value(self.memory[self.counter + 1])
-        self.stack.append(a)
-        self.counter += 2
-
-    def pop(self):
-        # pop: 3 a
-        #   remove the top element from the stack and write it into <a>; empty stack = error
-        a = self.memory[self.counter + 1]
-        self.set_value(a, self.stack.pop())
-        self.counter += 2
-
-    def eq(self):
-        # eq: 4 a b c
-        #   set <a> to 1 if <b> is equal to <c>; set it to 0 otherwise
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.set_value(a, 1 if b == c else 0)
-        self.counter += 4
-
-    def gt(self):
-        # gt: 5 a b c
-        #   set <a> to 1 if <b> is greater than <c>; set it to 0 otherwise
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.set_value(a, 1 if b > c else 0)
-        self.counter += 4
-
-    def jmp(self):
-        # jmp: 6 a
-        #   jump to <a>
-        a = self.memory[self.counter + 1]
-        self.counter = self.get_value(a)
-
-    def jt(self):
-        # jt: 7 a b
-        #   if <a> is nonzero, jump to <b>
-        a, b = [self.get_value(x) for x in self.memory[self.counter+1:self.counter+3]]
-        if a != 0:
-            self.counter = b
-        else:
-            self.counter += 3
-
-    def jf(self):
-        # jf: 8 a b
-        #   if <a> is zero, jump to <b>
-        a, b = [self.get_value(x) for x in self.memory[self.counter + 1:self.counter + 3]]
-        if a == 0:
-            self.counter = b
-        else:
-            self.counter += 3
-
-    def add(self):
-        # add: 9 a b c
-        #   assign into <a> the sum of <b> and <c> (modulo 32768)
-        a, b, c = self.memory[self.counter+1: self.counter+4]
-        b = self.get_value(b)
-        c = self.get_value(c)
-        result = (b + c) % 32768
-        self.set_value(a, result)
-        self.counter += 4
-
-    def mult(self):
-        # mult: 10 a b c
-        #   store into <a> the product of <b> and <c> (modulo 32768)
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.set_value(a, (b * c) % 32768)
-        self.counter += 4
-
-    def mod(self):
-        # mod: 11 a b c
-        #   store into <a> the remainder of <b> divided by <c>
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.set_value(a, b % c)
-        self.counter += 4
-
-    def and_opr(self):
-        # and: 12 a b c
-        #   stores into <a> the bitwise and of <b> and <c>
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.set_value(a, b & c)
-        self.counter += 4
-
-    def or_opr(self):
-        # or: 13 a b c
-        #   stores into <a> the bitwise or of <b> and <c>
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.set_value(a, b | c)
-        self.counter += 4
-
-    def not_opr(self):
-        # not: 14 a b
-        #   stores 15-bit bitwise inverse of <b> in <a>
-        a = self.memory[self.counter + 1]
-        b = self.get_value(self.memory[self.counter + 2])
-        self.set_value(a, ~b % 32768)
-        self.counter += 3
-
-    def rmem(self):
-        # rmem: 15 a b
-        #   read memory at address <b> and write it to <a>
-        a = self.memory[self.counter + 1]
-        b = self.get_value(self.memory[self.counter + 2])
-        self.set_value(a, self.memory[b])
-        self.counter += 3
-
-    def wmem(self):
-        # wmem: 16 a b
-        #   write the value from <b> into memory at address <a>
-        a, b = [self.get_value(x) for x in self.memory[self.counter + 1:self.counter + 3]]
-        self.set_value(a, b)
-        self.counter += 3
-
-    def call(self):
-        # call: 17 a
-        #   write the address of the next instruction to the stack and jump to <a>
-        a = self.get_value(self.memory[self.counter + 1])
-        self.stack.append(self.counter + 2)
-        self.counter = a
-
-    def ret(self):
-        # ret: 18
-        #   remove the top element from the stack and jump to it; empty stack = halt
-        self.counter = self.stack.pop()
-
-    def out(self):
-        # out: 19 a
-        #   write the character represented by ascii code <a> to the terminal
-        a = self.get_value(self.memory[self.counter + 1])
-        print(chr(a), end='')
-        self.counter += 2
-
-    def in_opr(self):
-        # in: 20 a
-        #   read a character from the terminal and write its ascii code to <a>;
-        #   it can be assumed that once input starts, it will continue until a
-        #   newline is encountered; this means that you can safely read whole
-        #   lines from the keyboard and trust that they will be fully read
+    def read_char(self) -> Optional[int]:
+        # the next input character, refilling the buffer a line at a time;
+        # None when no input is available
+        journal = self.journal
+        if journal is not None and journal.between_lines:
+            # the counter is on this in instruction and nothing of the next
+            # line is read, so a checkpoint here resumes by reading that line
+            journal.next_line(self)
         if len(self.input_buffer) == 0:
-            self.input_buffer = list(input('input: '))
-
-            self.input_buffer.append('\n')
-            self.command_log.write(''.join(self.input_buffer))
-        a = self.memory[self.counter + 1]
-        b = ord(self.input_buffer.pop(0))
-        self.set_value(a, b)
-        self.counter += 2
-
-    def noop(self):
-        # noop: 21
-        #   no operation
-        self.counter += 1
+            self.output.flush()
+            line = self.input_source.readline() if self.interactive else None
+            if line is None:
+                return None
+            if journal is not None:
+                journal.record(line)
+            self.input_buffer.extend(line)
+        char = self.input_buffer.popleft()
+        if journal is not None:
+            journal.read(char)
+        return ord(char)
 
+    def set_value(self, n, v):
+        self.memory[n] = v
+        self.dirty[n >> PAGE_BITS] = 1
 
-class VirtualMachineDis(VirtualMachine):
 
-    def __init__(self):
+class VirtualMachineCached(VirtualMachine):
+    # superinstructions are tried where an instruction has run <hot> times
+    def __init__(self, hot: int = HOT):
         super().__init__()
-        self.dis_file = Path('challenge.dis').open('w')
+        self.hot = hot
+        # address -> (handler, operands, next_pc), run as handler(vm, memory,
+        # address, stack, operands, next_pc) -> next counter; operands are the
+        # raw words, so registers are still 32768..32775
+        self.cache = [None] * 32768
+        # memory address -> opcode addresses of cached instructions covering it
+        self.covers = {}
+        # executions seen at addresses where a superinstruction could start
+        self.heat = [0] * 32768
 
     def run(self):
         self.running = True
-        while self.running:
-            try:
-                self.dis_file.write(f'{self.counter} - ')
-                self.operations[self.memory[self.counter]]()
-            except KeyError:
-                self.dis_file.write(f'{self.memory[self.counter]} - {chr(self.memory[self.counter])}')
-                self.counter += 1
-            except IndexError:
-                self.running = False
-
-    def get_value(self, n: int):
-        if n > 32767:
-            return f'reg{n-32768}'
-        return n
-
-    def halt(self):
-        # halt: 0
-        #   stop execution and terminate the program
-        self.dis_file.write('halt\n')
-        self.counter += 1
-
-    def set_opr(self):
-        # set: 1 a b
-        #   set register <a> to the value of <b>
-        a, b = self.memory[self.counter+1: self.counter+3]
-        a = f'reg{a-32768}'
-        b = self.get_value(b)
-        # self.set_value(a, b)
-        self.dis_file.write(f'set: {a=} {b=}\n')
-        self.counter += 3
-
-    def push(self):
-        # push: 2 a
-        #   push <a> onto the stack
-        a = self.get_value(self.memory[self.counter + 1])
-        # self.stack.append(a)
-        self.dis_file.write(f'push: {a=}\n')
-        self.counter += 2
-
-    def pop(self):
-        # pop: 3 a
-        #   remove the top element from the stack and write it into <a>; empty stack = error
-        a = self.get_value(self.memory[self.counter + 1])
-        # self.set_value(a, self.stack.pop())
-        self.dis_file.write(f'pop: {a=}\n')
-        self.counter += 2
-
-    def eq(self):
-        # eq: 4 a b c
-        #   set <a> to 1 if <b> is equal to <c>; set it to 0 otherwise
-        a = self.get_value(self.memory[self.counter + 1])
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        # self.set_value(a, 1 if b == c else 0)
-        self.dis_file.write(f'eq: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def gt(self):
-        # gt: 5 a b c
-        #   set <a> to 1 if <b> is greater than <c>; set it to 0 otherwise
-        a = self.get_value(self.memory[self.counter + 1])
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        # self.set_value(a, 1 if b > c else 0)
-        self.dis_file.write(f'gt: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def jmp(self):
-        # jmp: 6 a
-        #   jump to <a>
-        a = self.memory[self.counter + 1]
-        self.dis_file.write(f'jmp: {a=}\n')
-        self.counter += 2
-
-    def jt(self):
-        # jt: 7 a b
-        #   if <a> is nonzero, jump to <b>
-        a, b = [self.get_value(x) for x in self.memory[self.counter+1:self.counter+3]]
-        self.dis_file.write(f'jt: {a=} {b=}\n')
-        self.counter += 3
-
-    def jf(self):
-        # jf: 8 a b
-        #   if <a> is zero, jump to <b>
-        a, b = [self.get_value(x) for x in self.memory[self.counter + 1:self.counter + 3]]
-        self.dis_file.write(f'jf: {a=} {b=}\n')
-        self.counter += 3
-
-    def add(self):
-        # add: 9 a b c
-        #   assign into <a> the sum of <b> and <c> (modulo 32768)
-        a, b, c = self.memory[self.counter+1: self.counter+4]
-        a = self.get_value(a)
-        b = self.get_value(b)
-        c = self.get_value(c)
-        self.dis_file.write(f'add: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def mult(self):
-        # mult: 10 a b c
-        #   store into <a> the product of <b> and <c> (modulo 32768)
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.dis_file.write(f'mult: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def mod(self):
-        # mod: 11 a b c
-        #   store into <a> the remainder of <b> divided by <c>
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.dis_file.write(f'mod: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def and_opr(self):
-        # and: 12 a b c
-        #   stores into <a> the bitwise and of <b> and <c>
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.dis_file.write(f'and: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def or_opr(self):
-        # or: 13 a b c
-        #   stores into <a> the bitwise or of <b> and <c>
-        a = self.memory[self.counter + 1]
-        b, c = [self.get_value(x) for x in self.memory[self.counter + 2:self.counter + 4]]
-        self.dis_file.write(f'or: {a=} {b=} {c=}\n')
-        self.counter += 4
-
-    def not_opr(self):
-        # not: 14 a b
-        #   stores 15-bit bitwise inverse of <b> in <a>
-        a = self.memory[self.counter + 1]
-        b = self.get_value(self.memory[self.counter + 2])
-        self.dis_file.write(f'not: {a=} {b=}\n')
-        self.counter += 3
-
-    def rmem(self):
-        # rmem: 15 a b
-        #   read memory at address <b> and write it to <a>
-        a = self.memory[self.counter + 1]
-        b = self.get_value(self.memory[self.counter + 2])
-        self.dis_file.write(f'rmem: {a=} {b=}\n')
-        self.counter += 3
-
-    def wmem(self):
-        # wmem: 16 a b
-        #   write the value from <b> into memory at address <a>
-        a, b = [self.get_value(x) for x in self.memory[self.counter + 1:self.counter + 3]]
-        self.dis_file.write(f'wmem: {a=} {b=}\n')
-        self.counter += 3
-
-    def call(self):
-        # call: 17 a
-        #   write the address of the next instruction to the stack and jump to <a>
-        a = self.get_value(self.memory[self.counter + 1])
-        self.dis_file.write(f'call: {a=}\n')
-        self.counter += 2
-
-    def ret(self):
-        # ret: 18
-        #   remove the top element from the stack and jump to it; empty stack = halt
-        self.dis_file.write(f'ret\n')
-        self.counter += 1
-
-    def out(self):
-        # out: 19 a
-        #   write the character represented by ascii code <a> to the terminal
-        self.dis_file.write('out: ')
-        while True:
-
-            a = super().get_value(self.memory[self.counter + 1])
-            print(chr(a), end='')
-            self.dis_file.write(chr(a))
-            self.counter += 2
-            if self.memory[self.counter] != 19:
+        cache = self.cache
+        m = self.memory
+        st = self.stack
+        pc = self.counter
+        try:
+            while self.running:
+                entry = cache[pc]
+                if entry is None:
+                    entry = self.decode(pc)
+                pc = entry[0](self, m, pc, st, entry[1], entry[2])
+        finally:
+            self.counter = pc
+        self.output.flush()
+
+    def step(self, limit: int = 1) -> int:
+        # as VirtualMachine.step; a superinstruction counts as the
+        # instructions it fused
+        self.running = True
+        cache = self.cache
+        fused = VirtualMachineCached.c_fused
+        m = self.memory
+        st = self.stack
+        pc = self.counter
+        done = 0
+        try:
+            while self.running and done < limit:
+                entry = cache[pc]
+                if entry is None:
+                    entry = self.decode(pc)
+                handler, operands, next_pc = entry
+                if handler is fused:
+                    n = len(operands[0]) + (operands[1] is not None)
+                    if done + n > limit:
+                        # the limit falls inside the run, so its first
+                        # instruction is stepped alone
+                        pc = CHECKED_STEPS[m[pc]](self, m, pc, st)
+                        done += 1
+                        continue
+                    done += n
+                else:
+                    done += 1
+                pc = handler(self, m, pc, st, operands, next_pc)
+        finally:
+            self.counter = pc
+        return done - 1 if self.waiting() else done
+
+    def decode(self, address: int):
+        op = self.memory[address]
+        next_pc = address + 1 + ARITY[op]
+        entry = (DECODED_STEPS[op], tuple(self.memory[address + 1:next_pc]), next_pc)
+        for x in range(address, next_pc):
+            self.covers.setdefault(x, set()).add(address)
+        if op in FUSABLE or op in (2, 3, 15):
+            self.cache[address] = (VirtualMachineCached.c_warm, entry, next_pc)
+        else:
+            self.cache[address] = entry
+        return entry
+
+    def fuse(self, address: int):
+        # one entry running the straight-line code at <address>: register
+        # arithmetic, rmem, push and pop, optionally ended by a jump, call or
+        # ret, with no counter updates in between. Nothing in the run writes
+        # memory, so it can't modify itself. None for runs of fewer than two
+        m = self.memory
+        steps = []
+        tail = None
+        pc = address
+        while len(steps) < MAX_FUSED:
+            op = m[pc]
+            if op >= len(ARITY):
                 break
-        self.dis_file.write('\n')
-
-    def in_opr(self):
-        # in: 20 a
-        #   read a character from the terminal and write its ascii code to <a>;
-        #   it can be assumed that once input starts, it will continue until a
-        #   newline is encountered; this means that you can safely read whole
-        #   lines from the keyboard and trust that they will be fully read
-        # if len(self.input_buffer) == 0:
-        #     self.input_buffer = list(input('input: '))
-        #
-        #     self.input_buffer.append('\n')
-        #     self.command_log.write(''.join(self.input_buffer))
-        a = self.memory[self.counter + 1]
-        # b = ord(self.input_buffer.pop(0))
-        # self.set_value(a, b)
-        self.dis_file.write(f'in: {a=}\n')
-        self.counter += 2
-
-    def noop(self):
-        # noop: 21
-        #   no operation
-        self.dis_file.write(f'noop:\n')
-        self.counter += 1
\ No newline at end of file
+            raw = m[pc + 1:pc + 1 + ARITY[op]]
+            kinds = [x > 32767 for x in raw]
+            operands = [x - 32768 if x > 32767 else x for x in raw]
+            if op == 2:
+                steps.append((op, None, 0, operands[0], kinds[0], 0, False))
+            elif op in FUSABLE or op in (3, 15):
+                if not kinds[0]:
+                    break
+                b, kb = (operands[1], kinds[1]) if len(raw) > 1 else (0, False)
+                c, kc = (operands[2], kinds[2]) if len(raw) > 2 else (0, False)
+                steps.append((op, FUSABLE.get(op), operands[0], b, kb, c, kc))
+            else:
+                if op in (6, 7, 8, 17, 18):
+                    a, ka = (operands[0], kinds[0]) if raw else (0, False)
+                    b, kb = (operands[1], kinds[1]) if len(raw) > 1 else (0, False)
+                    tail = (op, a, ka, b, kb)
+                    pc += 1 + ARITY[op]
+                break
+            pc += 1 + ARITY[op]
+        if len(steps) + (tail is not None) < 2:
+            return None
+        for x in range(address, pc):
+            self.covers.setdefault(x, set()).add(address)
+        return VirtualMachineCached.c_fused, (tuple(steps), tail), pc
+
+    def set_value(self, n, v):
+        self.memory[n] = v
+        self.dirty[n >> PAGE_BITS] = 1
+        if n in self.covers:
+            for address in self.covers.pop(n):
+                self.cache[address] = None
+
+    def memory_reloaded(self, start: int, end: int):
+        for n in range(start, end):
+            if n in self.covers:
+                for address in self.covers.pop(n):
+                    self.cache[address] = None
+
+    def c_warm(self, m, pc, st, entry, next_pc):
+        # a plain entry where a superinstruction may start, swapped for one
+        # once it has run self.hot times
+        heat = self.heat
+        heat[pc] += 1
+        if heat[pc] >= self.hot:
+            self.cache[pc] = self.fuse(pc) or entry
+        return entry[0](self, m, pc, st, entry[1], entry[2])
+
+    def c_fused(self, m, pc, st, run, next_pc):
+        steps, tail = run
+        regs = self.registers
+        for op, fn, a, b, kb, c, kc in steps:
+            if fn is not None:
+                regs[a] = fn(regs[b] if kb else b, regs[c] if kc else c)
+            elif op == 2:
+                st.append(regs[b] if kb else b)
+            elif op == 3:
+                if not st:
+                    raise StackUnderflow(f'pop from an empty stack in the run at {pc}')
+                regs[a] = st.pop()
+            else:
+                regs[a] = m[regs[b] if kb else b]
+        if tail is None:
+            return next_pc
+        op, a, ka, b, kb = tail
+        a = regs[a] if ka else a
+        if op == 6:
+            return a
+        if op == 7:
+            return (regs[b] if kb else b) if a != 0 else next_pc
+        if op == 8:
+            return next_pc if a != 0 else (regs[b] if kb else b)
+        if op == 17:
+            if a in self.accelerated:
+                self.accelerated[a](self)
+                return next_pc
+            st.call(next_pc, a)
+            return a
+        address = st.ret()
+        if address is None:
+            # halt on the ret, which is the last word of the run
+            self.running = False
+            return next_pc - 1
+        return address
@@ -0,0 +1,55 @@
+import sys
+from typing import Optional
+
+
+class TerminalOutput:
+    # collects characters and writes them to stdout a line at a time
+    def __init__(self, line_buffered: bool = True):
+        self.line_buffered = line_buffered
+        self.pending = []
+
+    def write(self, text: str):
+        self.pending.append(text)
+        if '\n' in text and self.line_buffered:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            sys.stdout.write(''.join(self.pending))
+            sys.stdout.flush()
+            self.pending.clear()
+
+
+class BufferOutput:
+    # keeps everything written, for transcripts and searches
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, text: str):
+        self.chunks.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self) -> str:
+        return ''.join(self.chunks)
+
+    def clear(self):
+        self.chunks.clear()
+
+
+class NullOutput:
+    def write(self, text: str):
+        pass
+
+    def flush(self):
+        pass
+
+
+class TerminalInput:
+    def __init__(self, prompt: str = 'input: '):
+        self.prompt = prompt
+
+    def readline(self) -> Optional[str]:
+        return input(self.prompt) + '\n'
+